@@ -1,70 +1,611 @@
 import streamlit as st
 import os
-from openai import OpenAI
+import asyncio
 from dotenv import load_dotenv
-import base64
 import requests
 import json
+import time
+import queue
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from streaming import audio_duration
+from codec import TTS_FORMATS, encode_for_stt
+from partials import PartialTranscriber, same_transcript
+from media_server import MediaStore, start_media_server
+from ingest import IngestRegistry
+from sessions import History, open_store
+from archive import CallArchive
+from tts_cache import TTSCache
+from context import ContextWindow
+from engine import EngineLoop, StageDeadlines, VoiceEngine
+from scheduler import BACKGROUND, PREWARM, SPECULATIVE, Scheduler, prioritized
+from providers import Fallback, OpenAIChat, cpu_pool, make_stt, make_tts, openai_client
+from metrics import TurnTrace, configure_json_logging, count, observe, registry, span, tracing
+from vad import VoiceActivityDetector, VAD_SAMPLE_RATE, resample_frames
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=api_key)
+# Providers per stage (see providers.py). STT: openai | faster-whisper,
+# optionally with a fallback used when the first one is slow or failing.
+# Chat: any OpenAI-compatible endpoint (CHAT_BASE_URL). TTS: openai | piper
+# (TTS_MODEL is then the voice file) | gtts.
+STT_PROVIDER = os.getenv("STT_PROVIDER", "openai")
+STT_FALLBACK = os.getenv("STT_FALLBACK")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
+TTS_PROVIDER = os.getenv("TTS_PROVIDER", "openai")
+LOCAL_PROVIDERS = {"faster-whisper", "piper"}
+# Opus is a fraction of the size of MP3 for speech; TTS_FORMAT=mp3 for
+# browsers that cannot play Ogg/Opus (Safari before 17).
+TTS_FORMAT = os.getenv("TTS_FORMAT", "opus")
+# Caller audio is sent to STT as 16 kHz mono Opus unless STT_UPLOAD_FORMAT=wav.
+STT_UPLOAD_FORMAT = os.getenv("STT_UPLOAD_FORMAT", "opus")
+# Said when a turn fails after retries (a stage deadline, a shed request or an
+# API error), so the call carries on instead of ending the listen loop.
+FALLBACK_REPLY = "Sorry, I missed that. Could you say it again?"
+VOICES = ["onyx", "echo", "alloy", "fable", "shimmer", "nova"]
+
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+CONTEXT_KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "4"))
+CONTEXT_FOLD_TURNS = int(os.getenv("CONTEXT_FOLD_TURNS", "2"))
+
+# Messages drawn per rerun; earlier ones are drawn on request, so a rerun
+# costs the same late in a long call as at its start.
+TRANSCRIPT_TAIL = int(os.getenv("TRANSCRIPT_TAIL", "20"))
+
+# Every call's transcript, turn timings and audio are kept here for QA;
+# ARCHIVE_DIR= (empty) turns the archive off.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", ".archive")
+
+MEDIA_PORT = int(os.getenv("MEDIA_PORT", "8502"))
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", f"http://localhost:{MEDIA_PORT}")
+# How often an idle session checks for audio uploaded to its ingest URL,
+# once it has had an upload or "Watch for uploaded audio" is on; well inside
+# INGEST_PUT_TIMEOUT, so a new upload is not refused meanwhile.
+INGEST_POLL_S = float(os.getenv("INGEST_POLL_S", "1"))
+
+# The script reruns on every interaction; anything that must outlive a
+# rerun (the engine loop, pools, caches, the media server) is a process-wide
+# resource.
+@st.cache_resource
+def get_tts_cache(response_format):
+    # Named after what the TTS provider actually returns (gTTS is always MP3,
+    # piper has no MP3), which need not be TTS_FORMAT.
+    return TTSCache(
+        memory_bytes=int(os.getenv("TTS_CACHE_MEMORY_MB", "32")) * 1024 * 1024,
+        disk_dir=os.getenv("TTS_CACHE_DIR", ".tts_cache"),
+        disk_bytes=int(os.getenv("TTS_CACHE_DISK_MB", "512")) * 1024 * 1024,
+        extension=TTS_FORMATS[response_format][1],
+    )
+
+@st.cache_resource
+def get_engine_loop():
+    return EngineLoop()
+
+@st.cache_resource
+def get_cpu_pool():
+    # For in-process STT/TTS models; one worker per core unless CPU_WORKERS.
+    return cpu_pool(int(os.getenv("CPU_WORKERS", "0")) or None)
+
+@st.cache_resource
+def get_scheduler():
+    # One per process, so every session's requests share the account's rate
+    # limits (RATE_LIMITS="gpt-3.5-turbo=3500/90000,whisper-1=50,tts-1=50").
+    return Scheduler.from_env()
+
+@st.cache_resource
+def get_engine():
+    max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+    max_keepalive = int(os.getenv("OPENAI_MAX_KEEPALIVE", "16"))
+    client = openai_client(api_key, None, max_connections, max_keepalive)
+    chat_client = client
+    if os.getenv("CHAT_BASE_URL"):
+        chat_client = openai_client(os.getenv("CHAT_API_KEY", api_key), os.getenv("CHAT_BASE_URL"),
+                                    max_connections, max_keepalive)
+    pool = get_cpu_pool() if {STT_PROVIDER, STT_FALLBACK, TTS_PROVIDER} & LOCAL_PROVIDERS else None
+    stt = make_stt(STT_PROVIDER, client, pool, os.getenv("STT_MODEL"))
+    if STT_FALLBACK:
+        fallback = make_stt(STT_FALLBACK, client, pool, os.getenv("STT_FALLBACK_MODEL"))
+        stt = Fallback(stt, fallback, float(os.getenv("STT_FALLBACK_AFTER", "3")))
+    tts = make_tts(TTS_PROVIDER, client, pool, os.getenv("TTS_MODEL"), TTS_FORMAT)
+    return VoiceEngine(
+        deadlines=StageDeadlines.from_env(),
+        tts_cache=get_tts_cache(tts.response_format),
+        stt=stt,
+        chat=OpenAIChat(chat_client, CHAT_MODEL),
+        tts=tts,
+        scheduler=get_scheduler(),
+    )
+
+@st.cache_resource
+def get_session_store():
+    # Call history lives outside the process so a restart, or another
+    # replica behind the load balancer, can pick a call up. Use a shared
+    # redis:// store when running more than one replica.
+    return open_store(os.getenv("SESSION_STORE", "sqlite:///.sessions.db"))
+
+@st.cache_resource
+def get_archive():
+    # Written behind the turn by the archive's own thread; the turn path only
+    # enqueues.
+    return CallArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
+
+@st.cache_resource
+def get_summary_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def get_metrics():
+    # Prometheus text at /metrics on the media server; one JSON line per
+    # stage span on stderr unless METRICS_LOG=0.
+    if os.getenv("METRICS_LOG", "1") != "0":
+        configure_json_logging()
+    registry.register_collector("tts_cache", get_engine().tts_cache.stats)
+    registry.register_collector("ingest", get_ingest().stats)
+    registry.register_collector("scheduler", get_scheduler().stats)
+    if get_archive() is not None:
+        registry.register_collector("archive", get_archive().stats)
+    return registry
+
+@st.cache_resource
+def get_ingest():
+    return IngestRegistry(
+        max_chunks=int(os.getenv("INGEST_QUEUE_CHUNKS", "256")),
+        put_timeout=float(os.getenv("INGEST_PUT_TIMEOUT", "2")),
+    )
 
-def get_answer(messages, custom_prompt):
+@st.cache_resource
+def get_media_store():
+    # Also the ingest endpoint: callers' audio arrives at /ingest/<id> on the
+    # same port, so nothing competes with Streamlit for its own port.
+    store = MediaStore()
+    start_media_server(store, port=MEDIA_PORT, metrics=get_metrics(), ingest=get_ingest())
+    return store
+
+def prompt_messages(messages, custom_prompt, context=None):
+    if context is not None:
+        return context.build(custom_prompt, messages)
     system_message = [{
         "role": "system", 
         "content": custom_prompt
     }]
-    messages = system_message + messages
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        temperature=0.7,
-        timeout=5,
-        messages=messages
+    return system_message + messages
+
+def get_answer(messages, custom_prompt, context=None):
+    return engine_loop.run(engine.answer(prompt_messages(messages, custom_prompt, context)))
+
+def summarize_turns(summary, messages):
+    with prioritized(BACKGROUND):
+        return engine_loop.run(engine.summarize(summary, messages))
+
+def new_context_window(call_id):
+    context = ContextWindow(
+        summarize_turns,
+        max_tokens=CONTEXT_MAX_TOKENS,
+        keep_messages=2 * CONTEXT_KEEP_TURNS,
+        fold_messages=2 * CONTEXT_FOLD_TURNS,
+        model=CHAT_MODEL,
     )
-    return response.choices[0].message.content
-
-def speech_to_text(audio_data):
-    with open(audio_data, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            response_format="text",
-            file=audio_file
+    context.summary, context.summarized = get_session_store().load_summary(call_id)
+    return context
+
+def fold_context(context, turns, end, call_id):
+    summarized = context.summarized
+    context.fold(turns, end)
+    if context.summarized != summarized:
+        get_session_store().save_summary(call_id, context.summary, context.summarized)
+
+def open_call(call_id):
+    # Attach this session to a call's stored history. Messages load lazily,
+    # so reconnecting to a long call (?call=<id>) only reads what is shown
+    # or needed for the next prompt.
+    st.session_state.call_id = call_id
+    st.session_state.messages = History(get_session_store(), call_id)
+    st.session_state.context = new_context_window(call_id)
+    st.session_state.transcript_shown = TRANSCRIPT_TAIL
+    st.session_state.lead = st.query_params.get("lead")
+    st.query_params["call"] = call_id
+
+def add_message(message, trace=None):
+    # Appends to the call's history and hands a copy to the archive, with the
+    # turn's stage timings for replies.
+    st.session_state.messages.append(message)
+    archive = get_archive()
+    if archive is not None:
+        archive.message(
+            st.session_state.call_id, message, lead=st.session_state.get("lead"),
+            turn=trace.turn if trace is not None else None,
+            timings=trace.totals() if trace is not None else None,
         )
-    return transcript
 
-def text_to_speech(input_text, voice):
-    response = client.audio.speech.create(
-        model="tts-1",
-        voice=voice,
-        input=input_text
-    )
-    webm_file_path = "temp_audio_play.mp3"
-    with open(webm_file_path, "wb") as f:
-        response.stream_to_file(webm_file_path)
-    return webm_file_path
-
-def autoplay_audio(file_path: str):
-    with open(file_path, "rb") as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode("utf-8")
+def archive_speech(entry, synthesis=None):
+    # The clip may still be arriving; it is archived once complete.
+    archive = get_archive()
+    if archive is None:
+        return
+    call_id = st.session_state.call_id
+
+    def done(_=None):
+        if entry.complete and not entry.failed:
+            archive.audio(call_id, entry.data, "assistant", entry.content_type)
+
+    if synthesis is None:
+        done()
+    else:
+        synthesis.add_done_callback(done)
+
+def media_url(key):
+    return f"{MEDIA_BASE_URL}/media/{key}.{TTS_EXTENSION}"
+
+def start_speech(input_text, voice):
+    # The clip is keyed on what was synthesized, so repeats (the greeting) are
+    # served from the store and the browser cache; new clips stream to the
+    # browser while the TTS response is still arriving. Returns the key, the
+    # media entry and the synthesis future (None if nothing had to be made).
+    key = engine.tts_key(input_text, voice)
+    entry, created = get_media_store().open(key, TTS_CONTENT_TYPE)
+    synthesis = None
+    if created:
+        cached = engine.tts_cache.get(key)
+        if cached is not None:
+            entry.append(cached)
+            entry.finish()
+        else:
+            synthesis = engine_loop.submit(engine.stream_speech(input_text, voice, entry))
+    return key, entry, synthesis
+
+def text_to_speech_url(input_text, voice):
+    return media_url(start_speech(input_text, voice)[0])
+
+@st.cache_resource(max_entries=4)
+def prewarm_greeting(initial_message):
+    # Runs once per greeting text per process (for the last few texts). The
+    # clips land in the TTS cache, whose disk tier survives restarts, so
+    # "Call" rarely waits on TTS; nothing else is kept.
+    with prioritized(PREWARM):
+        for voice in VOICES:
+            engine_loop.submit(engine.synthesize(initial_message, voice))
+
+def publish_audio(data: bytes):
+    return media_url(get_media_store().put(data, TTS_CONTENT_TYPE))
+
+def autoplay_audio(src: str, container=st, segment=0):
     md = f"""
-    <audio autoplay>
-    <source src="data:audio/mp3;base64,{b64}" type="audio/mp3">
+    <audio autoplay data-segment="{segment}">
+    <source src="{src}" type="{TTS_CONTENT_TYPE}">
     </audio>
     """
-    st.markdown(md, unsafe_allow_html=True)
+    container.markdown(md, unsafe_allow_html=True)
+
+def deliver_audio(data: bytes, audio_placeholder, segment):
+    with span("deliver", segment=segment, bytes=len(data)):
+        autoplay_audio(publish_audio(data), audio_placeholder, segment)
+    if get_archive() is not None:
+        get_archive().audio(st.session_state.call_id, data, "assistant", TTS_CONTENT_TYPE)
+    return audio_duration(data)
+
+def wait_for_barge_in(seconds, barge_in):
+    # Sleeps for up to seconds; True if the caller started talking meanwhile.
+    if barge_in is None:
+        time.sleep(max(0.0, seconds))
+        return False
+    return barge_in.wait(max(0.0, seconds))
+
+def wait_for_playback(entry, barge_in):
+    # The clip may still be arriving; it plays for as long as it decodes to.
+    # False if the caller barged in first.
+    started = time.monotonic()
+    while not entry.complete:
+        if barge_in.is_set():
+            return False
+        entry.wait(timeout=0.05)
+    if entry.failed:
+        return True
+    return not wait_for_barge_in(started + audio_duration(entry.data) - time.monotonic(), barge_in)
+
+def speak_streaming(messages, voice, text_placeholder, audio_placeholder, answer=None, barge_in=None):
+    # The engine streams the reply and synthesizes each finished sentence
+    # while later ones are still being generated; segments play in order,
+    # each one swapped into the audio placeholder once the previous one has
+    # finished playing. If the caller starts talking, the rest of the reply
+    # is dropped: outstanding TTS requests are cancelled, the playing segment
+    # is removed and only the sentences that were played are returned.
+    pending = deque()
+    spoken = []
+    reply = ""
+    played = 0
+    play_until = 0.0
+    interrupted = False
+    start = time.perf_counter()
+    events = engine_loop.iterate(engine.reply_events(messages, voice, answer), poll=0.05)
+    try:
+        for event in events:
+            if barge_in is not None and barge_in.is_set():
+                interrupted = True
+                break
+            if event is not None:
+                kind, value = event
+                if kind == "token":
+                    reply += value
+                    text_placeholder.markdown(reply)
+                else:
+                    pending.append(value)
+            if pending and time.monotonic() >= play_until:
+                if not played:
+                    observe("first_audio", time.perf_counter() - start)
+                segment, audio = pending.popleft()
+                play_until = time.monotonic() + deliver_audio(audio, audio_placeholder, played)
+                spoken.append(segment)
+                played += 1
+        while pending and not interrupted:
+            interrupted = wait_for_barge_in(play_until - time.monotonic(), barge_in)
+            if not interrupted:
+                if not played:
+                    observe("first_audio", time.perf_counter() - start)
+                segment, audio = pending.popleft()
+                play_until = time.monotonic() + deliver_audio(audio, audio_placeholder, played)
+                spoken.append(segment)
+                played += 1
+        if barge_in is not None and not interrupted:
+            interrupted = wait_for_barge_in(play_until - time.monotonic(), barge_in)
+    finally:
+        events.close()
+    if not interrupted:
+        return reply
+    audio_placeholder.empty()
+    count("barge_ins", segments=played, after_s=round(time.perf_counter() - start, 3))
+    # Sentences whose TTS failed were never heard, so only the delivered
+    # ones go into the history.
+    spoken = " ".join(spoken)
+    text_placeholder.markdown(spoken)
+    return spoken
+
+def show_timings(trace):
+    totals = trace.totals()
+    st.caption(f"call {trace.call_id} · turn {trace.turn} · " + " · ".join(
+        f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in totals.items()
+    ))
+
+def speculated(answer):
+    # The speculative answer, or None if there was none or it failed; the
+    # turn then asks for a fresh one.
+    if answer is None:
+        return None
+    try:
+        return answer.result()
+    except Exception:
+        return None
+
+def reply(custom_prompt, voice, stream_reply, context, text_placeholder, answer=None, barge_in=None):
+    # Shows and speaks the reply and returns what was said; a stage that
+    # fails after retries raises.
+    answer = speculated(answer)
+    if stream_reply:
+        audio_placeholder = st.empty()
+        messages = prompt_messages(st.session_state.messages, custom_prompt, context)
+        return speak_streaming(messages, voice, text_placeholder, audio_placeholder, answer, barge_in)
+    with st.spinner("Thinking🤔..."):
+        final_response = answer or get_answer(st.session_state.messages, custom_prompt, context)
+    audio_placeholder = st.empty()
+    with st.spinner("Generating audio response..."):
+        with span("deliver"):
+            key, entry, synthesis = start_speech(final_response, voice)
+            autoplay_audio(media_url(key), audio_placeholder)
+            archive_speech(entry, synthesis)
+    text_placeholder.write(final_response)
+    if barge_in is not None and not wait_for_playback(entry, barge_in):
+        audio_placeholder.empty()
+        if synthesis is not None:
+            synthesis.cancel()
+    return final_response
+
+def respond(custom_prompt, voice, stream_reply, trace=None, answer=None, barge_in=None):
+    # answer: future of a reply started speculatively from a partial
+    # transcript. barge_in: event set when the caller starts talking, which
+    # cuts the reply short.
+    context = st.session_state.context
+    trace = trace or TurnTrace(st.session_state.call_id)
+    # The greeting, then a reply after every caller message: the caller's
+    # latest message is number len // 2, counted without loading the history.
+    trace.turn = len(st.session_state.messages) // 2
+    if barge_in is not None:
+        barge_in.clear()
+    from openai import APIError
+
+    with st.chat_message("assistant"), tracing(trace):
+        text_placeholder = st.empty()
+        try:
+            with span("reply"):
+                final_response = reply(custom_prompt, voice, stream_reply, context, text_placeholder, answer, barge_in)
+        except (asyncio.TimeoutError, APIError):
+            final_response = FALLBACK_REPLY
+            text_placeholder.write(final_response)
+    add_message({"role": "assistant", "content": final_response}, trace)
+    if st.session_state.get("debug_timings"):
+        show_timings(trace)
+    # Fold older turns into the summary off the turn path; the next prompt
+    # uses whatever summary is ready by then.
+    if context.needs_fold(st.session_state.messages):
+        turns, end = context.unfolded(st.session_state.messages)
+        get_summary_executor().submit(fold_context, context, turns, end, st.session_state.call_id)
+
+class WebRtcSource:
+    # Caller audio from the streamlit-webrtc receiver. Sources give capture
+    # raw chunks (get) and turn them into 16 kHz mono samples (decode);
+    # ingest.IngestSession is the other one.
+
+    def __init__(self, webrtc_ctx):
+        import av
+
+        self.webrtc_ctx = webrtc_ctx
+        self.resampler = av.AudioResampler(format="s16", layout="mono", rate=VAD_SAMPLE_RATE)
+
+    @property
+    def live(self):
+        return self.webrtc_ctx.state.playing
+
+    def get(self, timeout=None):
+        return self.webrtc_ctx.audio_receiver.get_frames(timeout=timeout)
+
+    def decode(self, frames):
+        return resample_frames(frames, self.resampler)
+
+def capture_utterances(source, transcripts, stop, call_id, barge_in, archive=None):
+    # Runs on its own thread so capture, endpointing and transcription of the
+    # next utterance carry on while the script thread is busy answering.
+    # While the caller is still talking, overlapping windows are transcribed
+    # and stitched; a stable partial is queued as ("partial", trace, text)
+    # ahead of the ("final", trace, future) for the whole utterance.
+    detector = VoiceActivityDetector(sample_rate=VAD_SAMPLE_RATE)
+    partials = PartialTranscriber(VAD_SAMPLE_RATE)
+    windows = deque()
+    trace = TurnTrace(call_id)
+    decode_seconds = vad_seconds = 0.0
+
+    def finish(utterance):
+        nonlocal trace, decode_seconds, vad_seconds
+        while windows:
+            windows.popleft()[1].cancel()
+        partials.reset()
+        with tracing(trace):
+            observe("decode", decode_seconds)
+            observe("vad", vad_seconds)
+            with span("capture", seconds_of_audio=round(len(utterance) / VAD_SAMPLE_RATE, 2)):
+                upload, filename = encode_for_stt(utterance, STT_UPLOAD_FORMAT)
+            if archive is not None:
+                archive.audio(call_id, upload, "user", TTS_FORMATS[STT_UPLOAD_FORMAT][0])
+            transcripts.put(("final", trace, engine_loop.submit(engine.transcribe(upload, filename))))
+        trace = TurnTrace(call_id)
+        decode_seconds = vad_seconds = 0.0
+
+    while source.live and not stop.is_set():
+        try:
+            chunk = source.get(timeout=1)
+        except queue.Empty:
+            continue
+        start = time.perf_counter()
+        samples = source.decode(chunk)
+        decoded = time.perf_counter()
+        was_speaking = detector.in_speech
+        utterances = detector.feed(samples)
+        decode_seconds += decoded - start
+        vad_seconds += time.perf_counter() - decoded
+        if utterances or (detector.in_speech and not was_speaking):
+            barge_in.set()
+        window = partials.next_window(detector.buffered_samples, detector.trailing_silence_ms)
+        if window is not None:
+            upload, filename = encode_for_stt(detector.buffered(window[0]), STT_UPLOAD_FORMAT)
+            with tracing(trace), prioritized(SPECULATIVE):
+                windows.append((window, engine_loop.submit(engine.transcribe(upload, filename, "stt_partial"))))
+        while windows and windows[0][1].done():
+            window, future = windows.popleft()
+            if future.cancelled() or future.exception() is not None:
+                continue
+            stable = partials.update(window, future.result())
+            if stable:
+                transcripts.put(("partial", trace, stable))
+        for utterance in utterances:
+            finish(utterance)
+    if not stop.is_set():
+        # The stream ended mid-utterance (an upload need not end in silence):
+        # what was said last is still answered.
+        utterance = detector.flush()
+        if utterance is not None:
+            finish(utterance)
+
+def speculate(partial, custom_prompt):
+    # Start the reply to a transcript the caller may not have finished; only
+    # the chat request is made, TTS waits until the final transcript agrees.
+    prompt = prompt_messages(st.session_state.messages, custom_prompt, st.session_state.context)
+    prompt.append({"role": "user", "content": partial})
+    with prioritized(SPECULATIVE):
+        return engine_loop.submit(engine.answer(prompt))
+
+def listen(source, custom_prompt, voice, stream_reply):
+    # Runs for as long as the caller's stream is live: every finished utterance
+    # is transcribed and answered straight away, no fixed-length chunks.
+    from openai import APIError
+
+    transcripts = queue.Queue()
+    stop = threading.Event()
+    barge_in = threading.Event()
+    capture = threading.Thread(
+        target=capture_utterances,
+        args=(source, transcripts, stop, st.session_state.call_id, barge_in, get_archive()),
+        daemon=True,
+    )
+    capture.start()
+    speculation = None
+    try:
+        # Until capture has stopped and everything it queued is answered.
+        while capture.is_alive() or not transcripts.empty():
+            try:
+                kind, trace, value = transcripts.get(timeout=1)
+            except queue.Empty:
+                continue
+            if kind == "partial":
+                if speculation is None or not same_transcript(speculation[0], value):
+                    if speculation is not None:
+                        speculation[1].cancel()
+                    with tracing(trace):
+                        speculation = (value, speculate(value, custom_prompt))
+                continue
+            try:
+                transcript = value.result()
+            except (asyncio.TimeoutError, APIError):
+                continue
+            answer = None
+            if speculation is not None:
+                partial, future = speculation
+                speculation = None
+                if transcript and same_transcript(partial, transcript):
+                    answer = future
+                else:
+                    future.cancel()
+                with tracing(trace):
+                    count("speculations", "hit" if answer is not None else "miss")
+            if transcript and transcript.strip():
+                add_message({"role": "user", "content": transcript})
+                with st.chat_message("user"):
+                    st.write(transcript)
+                respond(custom_prompt, voice, stream_reply, trace, answer, barge_in)
+    finally:
+        stop.set()
+        if speculation is not None:
+            speculation[1].cancel()
+
+def show_earlier_messages():
+    st.session_state.transcript_shown = st.session_state.get("transcript_shown", TRANSCRIPT_TAIL) + TRANSCRIPT_TAIL
+
+def show_transcript(messages):
+    # Only the latest messages are drawn (and, with History, loaded); new
+    # turns are appended below them as they happen by listen and respond.
+    start = max(0, len(messages) - st.session_state.get("transcript_shown", TRANSCRIPT_TAIL))
+    if start:
+        st.button(f"Show earlier messages ({start})", on_click=show_earlier_messages)
+    for message in messages[start:]:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
 
 # Streamlit interface
 st.title("Reactive Space Agent")
 
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "call_id" not in st.session_state:
+    open_call(st.query_params.get("call") or uuid.uuid4().hex[:12])
+if "ingest_id" not in st.session_state:
+    st.session_state.ingest_id = uuid.uuid4().hex
+ingest_session = get_ingest().open(st.session_state.ingest_id)
+
+st.sidebar.checkbox("Show turn timings", key="debug_timings")
+st.sidebar.checkbox("Watch for uploaded audio", key="ingest_watch")
+st.sidebar.caption(f"Audio ingest (audio/L16; rate={VAD_SAMPLE_RATE}): POST {MEDIA_BASE_URL}/ingest/{st.session_state.ingest_id}")
 
 # Add inputs for initial message, voice selection, and custom prompt
 initial_message = st.text_input("Initial Message", value="How can I help you?")
-voice = st.selectbox("Select Voice", ["onyx", "echo", "alloy", "fable","shimmer","nova"])
+voice = st.selectbox("Select Voice", VOICES)
+stream_reply = st.checkbox("Stream response", value=True)
 custom_prompt = st.text_area("Custom Prompt", value="""Hey {Lead Name}, this is Basit Ali calling, How are you doing today? I am good, thanks for asking....... so {lead name} the purpose of my call is in response to your recent FB Ads inquiry where you were seeking further information surrounding MetaVerse services…
 Do you remember booking the appointment?
 yes : Move on
@@ -84,120 +625,63 @@ Note: Confirm the value back to them, example I want to sell 10 products at 10k
 Rebuttal to question 2:
 It’s really important we have an understanding of your goals so we can help design the right solution to help you achieve that goal, so is there a revenue goal you have?""")
 
+# The page above is drawn before the API client and the audio stack are
+# loaded; on a cold start those imports are most of the wait.
+engine_loop = get_engine_loop()
+engine = get_engine()
+TTS_CONTENT_TYPE, TTS_EXTENSION = TTS_FORMATS[engine.tts.response_format]
+get_media_store()
+prewarm_greeting(initial_message)
+
 # Add a "Call" button
 if st.button("Call"):
-    initial_audio_path = text_to_speech(initial_message, voice)
-    st.session_state.initial_audio_path = initial_audio_path
-    st.session_state.messages.append({"role": "assistant", "content": initial_message})
+    open_call(uuid.uuid4().hex[:12])
+    st.session_state.initial_audio_url = text_to_speech_url(initial_message, voice)
+    add_message({"role": "assistant", "content": initial_message})
 
 # Play the initial greeting audio if it exists
-if "initial_audio_path" in st.session_state and st.session_state.initial_audio_path:
-    autoplay_audio(st.session_state.initial_audio_path)
-    os.remove(st.session_state.initial_audio_path)
-    del st.session_state.initial_audio_path
+if st.session_state.get("initial_audio_url"):
+    autoplay_audio(st.session_state.initial_audio_url)
+    del st.session_state.initial_audio_url
 
 # Display previous messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.write(message["content"])
-
-# Embed JavaScript for continuous recording
-st.markdown("""
-<script>
-var mediaRecorder;
-var audioChunks = [];
-navigator.mediaDevices.getUserMedia({ audio: true })
-    .then(stream => {
-        mediaRecorder = new MediaRecorder(stream);
-        mediaRecorder.start();
-
-        mediaRecorder.addEventListener("dataavailable", event => {
-            audioChunks.push(event.data);
-        });
-
-        mediaRecorder.addEventListener("stop", () => {
-            var audioBlob = new Blob(audioChunks, { type: 'audio/wav' });
-            var reader = new FileReader();
-            reader.readAsDataURL(audioBlob);
-            reader.onloadend = function() {
-                var base64data = reader.result;
-                fetch('/audio', {
-                    method: 'POST',
-                    body: JSON.stringify({ audio: base64data }),
-                    headers: { 'Content-Type': 'application/json' }
-                });
-            }
-            audioChunks = [];
-            mediaRecorder.start();
-        });
-
-        setInterval(() => {
-            mediaRecorder.stop();
-        }, 5000); // Record 5 seconds of audio at a time
-    });
-</script>
-""", unsafe_allow_html=True)
-
-# Backend to handle audio data
-if st.experimental_get_query_params().get("audio"):
-    audio_data = st.experimental_get_query_params()["audio"]
-    with open("temp_audio.wav", "wb") as f:
-        f.write(base64.b64decode(audio_data.split(",")[1]))
-    transcript = speech_to_text("temp_audio.wav")
-    if transcript:
-        st.session_state.messages.append({"role": "user", "content": transcript})
-        with st.chat_message("user"):
-            st.write(transcript)
-        os.remove("temp_audio.wav")
+show_transcript(st.session_state.messages)
+
+# Capture caller audio over WebRTC; utterances are endpointed server-side
+from streamlit_webrtc import webrtc_streamer, WebRtcMode
+
+webrtc_ctx = webrtc_streamer(
+    key="caller-audio",
+    mode=WebRtcMode.SENDONLY,
+    audio_receiver_size=256,
+    media_stream_constraints={"video": False, "audio": True},
+)
 
 if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking🤔..."):
-            final_response = get_answer(st.session_state.messages, custom_prompt)
-        with st.spinner("Generating audio response..."):
-            audio_file = text_to_speech(final_response, voice)
-            autoplay_audio(audio_file)
-        st.write(final_response)
-        st.session_state.messages.append({"role": "assistant", "content": final_response})
+    respond(custom_prompt, voice, stream_reply)
 
 # Footer
 footer_text = "Reactive Space Agent © 2024"
 st.markdown(f"<div style='position:fixed;bottom:0;width:100%;text-align:center;'>{footer_text}</div>", unsafe_allow_html=True)
-""")
-
-### Backend Handling in Streamlit
-
-To handle the audio data received from the JavaScript code, you will need to set up an endpoint in Streamlit that can receive POST requests. You can use the `st.experimental_singleton` to achieve this.
-
-```python
-import streamlit as st
-from flask import Flask, request, jsonify
-import threading
-import json
-
-app = Flask(__name__)
-
-@app.route('/audio', methods=['POST'])
-def handle_audio():
-    data = request.json
-    audio_data = data['audio']
-    with open("temp_audio.wav", "wb") as f:
-        f.write(base64.b64decode(audio_data.split(",")[1]))
-    transcript = speech_to_text("temp_audio.wav")
-    if transcript:
-        st.session_state.messages.append({"role": "user", "content": transcript})
-        with st.chat_message("user"):
-            st.write(transcript)
-        os.remove("temp_audio.wav")
-    return jsonify(success=True)
-
-def run_flask():
-    app.run(port=8501)
-
-if __name__ == '__main__':
-    threading.Thread(target=run_flask).start()
-    st.experimental_singleton(get_answer, speech_to_text, text_to_speech, autoplay_audio)
 
+@st.fragment(run_every=INGEST_POLL_S)
+def watch_ingest(session):
+    # Timed fragment runs carry on between script runs (and never preempt
+    # one); an upload arriving while the script is idle starts a full run,
+    # whose listen() drains and answers it.
+    if session.live:
+        st.rerun()
+
+# Uploaded audio is queued per session (bounded, see ingest.py) until the
+# script gets here and starts draining it; when no run is in progress,
+# watch_ingest starts one. Its timer only runs for sessions that use ingest,
+# so idle tabs cost nothing between interactions.
+if webrtc_ctx.audio_receiver:
+    listen(WebRtcSource(webrtc_ctx), custom_prompt, voice, stream_reply)
+elif ingest_session.live:
+    listen(ingest_session, custom_prompt, voice, stream_reply)
+if st.session_state.get("ingest_watch") or ingest_session.started:
+    watch_ingest(ingest_session)
 
 
 
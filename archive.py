@@ -0,0 +1,248 @@
+import atexit
+import json
+import logging
+import mmap
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Segment files hold records back to back, never rewritten:
+#   magic, kind, header length, body length, CRC-32 of header + body
+#   header: JSON (call_id, lead, ts and the kind's fields)
+#   body: the message text in UTF-8, or the audio bytes
+# The index (SQLite, next to the segments) has each record's segment, offset
+# and length by call, and each call's lead and time span, so reading a call
+# touches only its own records.
+RECORD = struct.Struct("<2sBxIII")
+MAGIC = b"CA"
+MESSAGE, AUDIO = 1, 2
+KINDS = {MESSAGE: "message", AUDIO: "audio"}
+
+
+def segment_name(number):
+    return f"segment-{number:06d}.log"
+
+
+class CallArchive:
+    # Transcripts, turn timings and audio of every call. The turn path only
+    # enqueues (never blocks: when the writer falls behind by max_queued
+    # records, new ones are dropped and counted); one writer thread appends
+    # them in batches, one write and one index transaction per batch.
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, max_queued=10000, batch=256):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch = batch
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._maps = {}
+        self._read_lock = threading.Lock()
+        self._index_path = os.path.join(directory, "index.db")
+        self._reader = self._connect()
+        self._reader.executescript(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " call_id TEXT NOT NULL, ts REAL NOT NULL, kind INTEGER NOT NULL,"
+            " segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS records_call ON records (call_id, segment, offset);"
+            "CREATE TABLE IF NOT EXISTS calls ("
+            " call_id TEXT PRIMARY KEY, lead TEXT, started REAL NOT NULL, ended REAL NOT NULL,"
+            " records INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS calls_lead ON calls (lead, started);"
+            "CREATE INDEX IF NOT EXISTS calls_started ON calls (started);"
+        )
+        self._segment, self._file = self._open_segment()
+        self._writer = threading.Thread(target=self._run, name="call-archive", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        db = sqlite3.connect(self._index_path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _open_segment(self):
+        # Appends to the newest segment, cut back to its last indexed record:
+        # anything after it was being written when the process stopped.
+        row = self._reader.execute("SELECT MAX(segment) FROM records").fetchone()
+        number = row[0] or 1
+        (end,) = self._reader.execute(
+            "SELECT COALESCE(MAX(offset + length), 0) FROM records WHERE segment = ?", (number,)
+        ).fetchone()
+        f = open(os.path.join(self.directory, segment_name(number)), "ab")
+        if f.tell() > end:
+            f.truncate(end)
+            f.seek(end)
+        return number, f
+
+    # Writing (any thread)
+
+    def message(self, call_id, message, lead=None, turn=None, timings=None):
+        header = {"role": message["role"]}
+        if turn is not None:
+            header["turn"] = turn
+        if timings:
+            header["timings"] = timings
+        return self._put(MESSAGE, call_id, lead, header, message["content"].encode("utf-8"))
+
+    def audio(self, call_id, data, role, content_type, lead=None, turn=None):
+        header = {"role": role, "content_type": content_type}
+        if turn is not None:
+            header["turn"] = turn
+        return self._put(AUDIO, call_id, lead, header, bytes(data))
+
+    def _put(self, kind, call_id, lead, header, body):
+        try:
+            self._queue.put_nowait((kind, call_id, lead, time.time(), header, body))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        # Blocks until everything queued so far is written and indexed.
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    # The writer thread
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in items
+            try:
+                self._write_batch(db, [item for item in items if item is not None])
+            except Exception:
+                logger.exception("archive: dropped %d records", len(items))
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if stop:
+                self._file.close()
+                db.close()
+                return
+
+    def _write_batch(self, db, items):
+        # One buffered write, then the index: a record is only ever indexed
+        # once its bytes are in the segment file.
+        rows = []
+        calls = {}
+        chunks = []
+        offset = self._file.tell()
+        for kind, call_id, lead, ts, header, body in items:
+            if offset >= self.segment_bytes:
+                self._file.write(b"".join(chunks))
+                self._file.close()
+                chunks = []
+                self._segment += 1
+                # A file already there is left over from a crash mid-rotation
+                # (nothing in it was indexed): start it afresh.
+                self._file = open(os.path.join(self.directory, segment_name(self._segment)), "wb")
+                offset = 0
+            header = json.dumps({"call_id": call_id, "lead": lead, "ts": ts, **header}).encode("utf-8")
+            crc = zlib.crc32(body, zlib.crc32(header))
+            record = RECORD.pack(MAGIC, kind, len(header), len(body), crc) + header + body
+            chunks.append(record)
+            rows.append((call_id, ts, kind, self._segment, offset, len(record)))
+            offset += len(record)
+            started, ended, count, known = calls.get(call_id, (ts, ts, 0, None))
+            calls[call_id] = (min(started, ts), max(ended, ts), count + 1, known or lead)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO records (call_id, ts, kind, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        db.executemany(
+            "INSERT INTO calls (call_id, lead, started, ended, records) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (call_id) DO UPDATE SET lead = COALESCE(calls.lead, excluded.lead),"
+            " started = MIN(calls.started, excluded.started), ended = MAX(calls.ended, excluded.ended),"
+            " records = calls.records + excluded.records",
+            [(call_id, lead, started, ended, count) for call_id, (started, ended, count, lead) in calls.items()],
+        )
+        db.execute("COMMIT")
+        self.written += len(rows)
+
+    # Reading (any thread)
+
+    def _view(self, segment, end):
+        # Segments are mapped once; the one being appended to is remapped
+        # when a record lies past the end of the current mapping.
+        view = self._maps.get(segment)
+        if view is None or len(view) < end:
+            with open(os.path.join(self.directory, segment_name(segment)), "rb") as f:
+                view = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return view
+
+    def call(self, call_id):
+        # Every record of the call, oldest first: messages as
+        # {"kind": "message", "role", "content", ...} and audio as
+        # {"kind": "audio", "role", "content_type", "data", ...}.
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT segment, offset, length FROM records WHERE call_id = ? ORDER BY segment, offset",
+                (call_id,),
+            ).fetchall()
+            return [self._decode(self._view(segment, offset + length), offset) for segment, offset, length in rows]
+
+    @staticmethod
+    def _decode(view, offset):
+        magic, kind, header_length, body_length, crc = RECORD.unpack_from(view, offset)
+        start = offset + RECORD.size
+        header = view[start:start + header_length]
+        body = view[start + header_length:start + header_length + body_length]
+        if magic != MAGIC or zlib.crc32(body, zlib.crc32(header)) != crc:
+            raise ValueError(f"corrupt archive record at offset {offset}")
+        record = {"kind": KINDS[kind], **json.loads(header)}
+        if kind == MESSAGE:
+            record["content"] = body.decode("utf-8")
+        else:
+            record["data"] = body
+        return record
+
+    def calls(self, lead=None, since=None, until=None, limit=100):
+        # Newest first: {"call_id", "lead", "started", "ended", "records"}.
+        where, params = [], []
+        if lead is not None:
+            where.append("lead = ?")
+            params.append(lead)
+        if since is not None:
+            where.append("started >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("started < ?")
+            params.append(until)
+        query = "SELECT call_id, lead, started, ended, records FROM calls"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        with self._read_lock:
+            rows = self._reader.execute(query + " ORDER BY started DESC LIMIT ?", (*params, limit)).fetchall()
+        return [dict(zip(("call_id", "lead", "started", "ended", "records"), row)) for row in rows]
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written_total": self.written,
+            "dropped_total": self.dropped,
+            "segments": self._segment,
+        }
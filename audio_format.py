@@ -0,0 +1,4 @@
+# Caller audio is endpointed and uploaded as 16 kHz mono int16 PCM. Kept
+# apart from vad.py so the media server and ingest can check an upload's
+# format without loading numpy.
+VAD_SAMPLE_RATE = 16000
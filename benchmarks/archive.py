@@ -0,0 +1,121 @@
+# What archiving a turn costs the turn itself (handing records to the
+# write-behind queue vs writing them inline), and reading one call back via
+# the index and mmap vs scanning every segment.
+#   python -m benchmarks.archive [--turns N] [--calls N]
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from archive import RECORD, CallArchive
+
+# One turn as the app archives it: the caller's utterance (~3 s of 24 kbps
+# Opus) and transcript, the reply (~10 s of 32 kbps Opus) and its text and
+# stage timings.
+UTTERANCE = os.urandom(9_000)
+REPLY_AUDIO = os.urandom(40_000)
+TRANSCRIPT = {"role": "user", "content": "Yes, I remember booking it, I wanted to know more about the pricing."}
+REPLY = {"role": "assistant", "content": "Great. " * 40}
+TIMINGS = {"stt": 0.41, "first_token": 0.32, "first_audio": 0.61, "tts": 0.22, "reply": 1.9}
+
+
+def archive_turn(archive, call_id, turn):
+    archive.audio(call_id, UTTERANCE, "user", "audio/ogg", turn=turn)
+    archive.message(call_id, TRANSCRIPT, lead=f"lead-{call_id}", turn=turn)
+    archive.audio(call_id, REPLY_AUDIO, "assistant", "audio/ogg", turn=turn)
+    archive.message(call_id, REPLY, turn=turn, timings=TIMINGS)
+
+
+class InlineArchive:
+    # The same records written on the caller's thread, one commit per record:
+    # what archiving would cost without the writer thread.
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.db = archive._connect()
+
+    def message(self, call_id, message, lead=None, turn=None, timings=None):
+        header = {"role": message["role"], "turn": turn, "timings": timings}
+        self.archive._write_batch(self.db, [(1, call_id, lead, time.time(), header, message["content"].encode())])
+
+    def audio(self, call_id, data, role, content_type, lead=None, turn=None):
+        header = {"role": role, "content_type": content_type, "turn": turn}
+        self.archive._write_batch(self.db, [(2, call_id, lead, time.time(), header, data)])
+
+
+def turn_latency(archive, turns):
+    samples = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        archive_turn(archive, f"call-{turn % 50}", turn)
+        samples.append(time.perf_counter() - start)
+        # Turns are seconds apart; give the writer the gap it would have.
+        time.sleep(0.002)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)], samples[-1]
+
+
+def scan(directory, call_id):
+    # Without the index: read every segment and parse every record header.
+    records = []
+    for name in sorted(f for f in os.listdir(directory) if f.startswith("segment-")):
+        with open(os.path.join(directory, name), "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            _, _, header_length, body_length, _ = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            header = json.loads(data[start:start + header_length])
+            if header["call_id"] == call_id:
+                records.append(data[start + header_length:start + header_length + body_length])
+            offset = start + header_length + body_length
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--calls", type=int, default=1000, help="calls in the archive for the read test")
+    parser.add_argument("--reads", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        archive = CallArchive(os.path.join(directory, "behind"))
+        behind = turn_latency(archive, args.turns)
+        archive.flush()
+        inline = turn_latency(InlineArchive(CallArchive(os.path.join(directory, "inline"))), args.turns)
+        print(f"archiving one turn (4 records, {(len(UTTERANCE) + len(REPLY_AUDIO)) / 1024:.0f} KiB of audio), "
+              f"{args.turns} turns:")
+        for name, (p50, p99, worst) in (("write-behind", behind), ("inline write", inline)):
+            print(f"  {name:<14} p50 {p50 * 1e6:8.1f} us   p99 {p99 * 1e6:8.1f} us   max {worst * 1e6:8.1f} us")
+        archive.close()
+
+        path = os.path.join(directory, "read")
+        archive = CallArchive(path)
+        for call in range(args.calls):
+            for turn in range(4):
+                archive_turn(archive, f"call-{call}", turn)
+            if call % 100 == 99:
+                archive.flush()
+        archive.flush()
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        picks = [f"call-{random.randrange(args.calls)}" for _ in range(args.reads)]
+        start = time.perf_counter()
+        for call_id in picks:
+            assert len(archive.call(call_id)) == 16
+        indexed = (time.perf_counter() - start) / len(picks)
+        start = time.perf_counter()
+        for call_id in picks[:3]:
+            assert len(scan(path, call_id)) == 16
+        scanned = (time.perf_counter() - start) / 3
+        print(f"reading one call back, {args.calls} calls ({size / 2**20:.0f} MiB, "
+              f"{len([n for n in os.listdir(path) if n.startswith('segment-')])} segments):")
+        print(f"  {'index + mmap':<14} {indexed * 1000:8.2f} ms")
+        print(f"  {'full scan':<14} {scanned * 1000:8.2f} ms  ({scanned / indexed:.0f}x)")
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Bytes on the wire per turn with and without the Opus stage, for the STT
+# upload (what the browser recorded vs 16 kHz mono Opus) and the TTS download
+# (tts-1's MP3 vs Opus), plus the CPU spent encoding.
+#   python -m benchmarks.audio_codec [--seconds S] [--reply-seconds S] [--turns N]
+import argparse
+import io
+import time
+
+import av
+import numpy as np
+
+from codec import decode_pcm, encode_opus, transcode_for_stt
+from vad import pcm_to_wav
+
+
+def speech_like(seconds, rate, channels=1):
+    # A voiced tone with syllable-rate amplitude modulation and some noise;
+    # codecs treat it much like speech, unlike white noise or silence.
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    voice = np.sin(2 * np.pi * np.cumsum(pitch) / rate)
+    voice += 0.5 * np.sin(4 * np.pi * np.cumsum(pitch) / rate)
+    envelope = np.clip(np.sin(2 * np.pi * 3 * t), 0, None) ** 0.5
+    samples = 6000 * voice * envelope + rng.normal(0, 150, t.size)
+    return np.repeat(samples.astype(np.int16)[None, :], channels, axis=0)
+
+
+def encode(samples, rate, codec, container_format, bitrate=None):
+    # Planar (channels, n) int16 samples in the given codec and container.
+    layout = "mono" if samples.shape[0] == 1 else "stereo"
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format=container_format) as container:
+        stream = container.add_stream(codec, rate=rate, layout=layout)
+        if bitrate:
+            stream.bit_rate = bitrate
+        frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(samples), format="s16p", layout=layout)
+        frame.sample_rate = rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def timed(function, turns):
+    start = time.perf_counter()
+    for _ in range(turns):
+        result = function()
+    return result, (time.perf_counter() - start) / turns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5.0, help="caller utterance length")
+    parser.add_argument("--reply-seconds", type=float, default=10.0, help="agent reply length")
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+
+    # What reached STT before: the browser's own recording (MediaRecorder
+    # WebM/Opus at its default bitrate, or 48 kHz stereo PCM), or the 16 kHz
+    # WAV the VAD path produced.
+    browser = speech_like(args.seconds, 48000, channels=2)
+    webm = encode(browser, 48000, "libopus", "webm", 128000)
+    uploads = [
+        ("browser WAV 48 kHz stereo", encode(browser, 48000, "pcm_s16le", "wav")),
+        ("browser WebM/Opus 128 kbps", webm),
+        ("VAD WAV 16 kHz mono", pcm_to_wav(speech_like(args.seconds, 16000)[0])),
+    ]
+    opus, encode_seconds = timed(lambda: encode_opus(speech_like(args.seconds, 16000)[0]), args.turns)
+    _, transcode_seconds = timed(lambda: transcode_for_stt(webm), args.turns)
+
+    print(f"STT upload, {args.seconds:g} s utterance:")
+    for name, data in uploads:
+        print(f"  {name:<30}{len(data) / 1024:8.1f} KiB  ({len(data) / len(opus):4.1f}x)")
+    print(f"  {'16 kHz mono Opus 24 kbps':<30}{len(opus) / 1024:8.1f} KiB  "
+          f"(encode {encode_seconds * 1000:.1f} ms, transcode from WebM {transcode_seconds * 1000:.1f} ms)")
+
+    # tts-1 returns 24 kHz mono; its MP3 is ~160 kbps. The Opus size is what
+    # libopus produces for the same audio at a speech bitrate, an estimate of
+    # what the endpoint returns for response_format="opus".
+    reply = speech_like(args.reply_seconds, 24000)
+    mp3 = encode(reply, 24000, "libmp3lame", "mp3", 160000)
+    reply_opus = encode(reply, 24000, "libopus", "ogg", 32000)
+    assert decode_pcm(reply_opus).size
+    print(f"TTS download, {args.reply_seconds:g} s reply:")
+    print(f"  {'MP3 160 kbps':<30}{len(mp3) / 1024:8.1f} KiB  ({len(mp3) / len(reply_opus):4.1f}x)")
+    print(f"  {'Ogg/Opus 32 kbps':<30}{len(reply_opus) / 1024:8.1f} KiB")
+    total_before = len(uploads[-1][1]) + len(mp3)
+    total_after = len(opus) + len(reply_opus)
+    print(f"per turn (VAD WAV + MP3 -> Opus both ways): {total_before / 1024:.1f} KiB -> "
+          f"{total_after / 1024:.1f} KiB ({total_before / total_after:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Per-turn cost of the old temp-file audio handoff versus the in-memory path
+# the app uses: encode_for_stt, the (filename, bytes) upload and the reply
+# published through MediaStore. Both send WAV, so only the handoff differs
+# (benchmarks.audio_codec covers Opus).
+#   python -m benchmarks.audio_io [--turns N]
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from codec import encode_for_stt
+from media_server import MediaStore
+from vad import pcm_to_wav
+
+# A 5 s caller utterance as 16 kHz samples and ~10 s tts-1 replies (~160 kbps
+# MP3), a different one each turn as in a call.
+UTTERANCE = np.random.default_rng(0).integers(-3000, 3000, 16000 * 5).astype(np.int16)
+REPLIES = [os.urandom(200_000) for _ in range(64)]
+REPLY = REPLIES[0]
+
+
+def disk_turn(directory, turn):
+    # What every turn used to do: write the upload, reopen it for the
+    # transcription request, write the TTS reply, reopen it for playback,
+    # then delete both files.
+    upload_path = os.path.join(directory, "temp_audio.wav")
+    reply_path = os.path.join(directory, "temp_audio_play.mp3")
+    with open(upload_path, "wb") as f:
+        f.write(pcm_to_wav(UTTERANCE))
+    with open(upload_path, "rb") as f:
+        sent = ("temp_audio.wav", f.read())
+    with open(reply_path, "wb") as f:
+        f.write(REPLIES[turn % len(REPLIES)])
+    with open(reply_path, "rb") as f:
+        played = f.read()
+    os.remove(upload_path)
+    os.remove(reply_path)
+    return len(sent[1]) + len(played)
+
+
+def memory_turn(store, turn):
+    # The app's path: the upload is a (filename, bytes) pair handed to the
+    # client, the reply is published in the media store (hashed, evicting
+    # older clips) and read back as the server would send it.
+    upload, filename = encode_for_stt(UTTERANCE, "wav")
+    sent = (filename, upload)
+    key = store.put(REPLIES[turn % len(REPLIES)])
+    played = store.get(key).data
+    return len(sent[1]) + len(played)
+
+
+def run(turn, turns, state):
+    start = time.perf_counter()
+    for index in range(turns):
+        turn(state, index)
+    return (time.perf_counter() - start) / turns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=2000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        disk = run(disk_turn, args.turns, directory)
+    memory = run(memory_turn, args.turns, MediaStore(max_bytes=8 * len(REPLY)))
+    io_bytes = 2 * (len(pcm_to_wav(UTTERANCE)) + len(REPLY))
+    print(f"turns: {args.turns}")
+    print(f"disk round-trip:  {disk * 1e6:9.1f} us/turn, {io_bytes / 1024:.0f} KiB written+read, 4 opens, 2 unlinks")
+    print(f"in-memory:        {memory * 1e6:9.1f} us/turn, 0 KiB file I/O")
+    print(f"difference:       {(memory - disk) * 1e6:+9.1f} us/turn (in-memory minus disk)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Run an outbound campaign headlessly: one call per lead in a CSV, the call
+# script rendered for each lead, many calls at once under a concurrency cap.
+#   python -m campaign leads.csv --prompt script.txt --concurrency 50 --checkpoint run.jsonl
+# Progress is appended to the checkpoint file as calls finish; running the
+# same command again skips the leads that are already done.
+#
+# The caller's side of each call is played from --audio clips, as in the
+# load test; a telephony bridge would feed real audio through the ingest
+# endpoint instead.
+import argparse
+import asyncio
+import csv
+import json
+import os
+import re
+import sys
+import time
+
+from archive import CallArchive
+from engine import StageDeadlines
+from loadtest import SYSTEM_PROMPT, Recorder, TimedEngine, format_report, simulate_call, synthetic_clip
+from mock_openai import MockLatency, mock_base_url, start_mock_server
+from providers import OpenAIChat, cpu_pool, make_stt, make_tts, openai_client
+from scheduler import Scheduler
+from sessions import History, open_store
+
+PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+
+def field_name(name):
+    # "{Lead Name}", "{lead name}" and a "lead_name" column are the same field.
+    return re.sub(r"[\s_-]+", " ", name).strip().lower()
+
+
+class Template:
+    # Split once into literal text and field lookups, so rendering a lead is
+    # a single join. Placeholders with no matching column are left as they
+    # are and listed in missing.
+
+    def __init__(self, text, columns):
+        fields = {field_name(column): column for column in columns}
+        self.parts = []
+        self.missing = set()
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            self.parts.append((text[position:match.start()], None))
+            column = fields.get(field_name(match.group(1)))
+            if column is None:
+                self.missing.add(match.group(1))
+                self.parts.append((match.group(0), None))
+            else:
+                self.parts.append(("", column))
+            position = match.end()
+        self.parts.append((text[position:], None))
+
+    def render(self, lead):
+        return "".join((lead.get(column) or "") if column else literal for literal, column in self.parts)
+
+
+def load_leads(path, id_column=None):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        leads = list(reader)
+        columns = reader.fieldnames or []
+    key = id_column or next((c for c in columns if field_name(c) in ("id", "lead id", "phone")), None)
+    for index, lead in enumerate(leads):
+        lead["_id"] = lead[key] if key else str(index)
+    return leads, columns
+
+
+def load_checkpoint(path):
+    # Latest status per lead; a partly written last line (the run was
+    # killed mid-write) is ignored.
+    done = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[record["lead"]] = record["status"]
+    return done
+
+
+async def run_campaign(engine, recorder, leads, template, clips, args, store, checkpoint, archive=None):
+    queue = asyncio.Queue()
+    for lead in leads:
+        queue.put_nowait(lead)
+    # Calls start no faster than --calls-per-minute, whatever the concurrency.
+    interval = 60.0 / args.calls_per_minute if args.calls_per_minute else 0.0
+    next_start = [time.monotonic()]
+
+    async def worker():
+        while not queue.empty():
+            lead = queue.get_nowait()
+            if interval:
+                start_at, next_start[0] = next_start[0], max(next_start[0], time.monotonic()) + interval
+                await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+            call_id = f"{args.campaign}-{lead['_id']}"
+            started = time.perf_counter()
+            messages = History(store, call_id)
+            start = len(messages)
+            if not start:
+                messages.append({"role": "assistant", "content": args.greeting})
+            try:
+                ok = await simulate_call(
+                    engine, recorder, clips, args.turns, args.voice, 0.0, template.render(lead), messages
+                )
+            except Exception:
+                ok = False
+            if archive is not None:
+                for message in messages[start:]:
+                    archive.message(call_id, message, lead=lead["_id"])
+            checkpoint.write(json.dumps({
+                "lead": lead["_id"],
+                "call_id": call_id,
+                "status": "done" if ok else "failed",
+                "turns": (len(messages) - 1) // 2,
+                "seconds": round(time.perf_counter() - started, 3),
+                "ts": time.time(),
+            }) + "\n")
+            checkpoint.flush()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(args.concurrency, len(leads)) or 1)))
+    return time.perf_counter() - start
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Call every lead in a CSV with the agent.")
+    parser.add_argument("leads", help="CSV with a header row; columns fill the {placeholders}")
+    parser.add_argument("--id-column", help="column that identifies a lead (default: id, lead id or phone, else row number)")
+    parser.add_argument("--prompt", help="call script with {Lead Name}-style placeholders")
+    parser.add_argument("--greeting", default="How can I help you?")
+    parser.add_argument("--campaign", default="campaign", help="name; call IDs are <campaign>-<lead id>")
+    parser.add_argument("--checkpoint", help="JSONL progress file; rerun with the same file to resume")
+    parser.add_argument("--retry-failed", action="store_true", help="on resume, call leads that failed again")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--calls-per-minute", type=float, default=0.0, help="cap on call starts (0: no cap)")
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--voice", default="onyx")
+    parser.add_argument("--audio", nargs="*", default=[], help="caller clips, used in rotation")
+    parser.add_argument("--session-store", default=os.getenv("SESSION_STORE", "sqlite:///.sessions.db"))
+    parser.add_argument("--archive", default=os.getenv("ARCHIVE_DIR", ".archive"),
+                        help="call archive directory, as for the app ('' to keep no archive)")
+    parser.add_argument("--base-url", help="API base URL (default: OpenAI)")
+    parser.add_argument("--api-key", default=os.getenv("OPENAI_API_KEY"))
+    parser.add_argument("--mock", action="store_true", help="run against the local OpenAI stand-in")
+    parser.add_argument("--max-connections", type=int, default=64)
+    parser.add_argument("--stt", default="openai")
+    parser.add_argument("--stt-model")
+    parser.add_argument("--tts", default="openai")
+    parser.add_argument("--tts-model")
+    parser.add_argument("--tts-format", default="mp3")
+    parser.add_argument("--cpu-workers", type=int)
+    parser.add_argument("--json", help="write the report to this path ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    leads, columns = load_leads(args.leads, args.id_column)
+    text = SYSTEM_PROMPT
+    if args.prompt:
+        with open(args.prompt, encoding="utf-8") as f:
+            text = f.read()
+    template = Template(text, columns)
+    if template.missing:
+        print(f"no column for {', '.join(sorted(template.missing))}; left as is", file=sys.stderr)
+
+    done = load_checkpoint(args.checkpoint)
+    skip = {"done", "failed"} if not args.retry_failed else {"done"}
+    pending = [lead for lead in leads if done.get(lead["_id"]) not in skip]
+    print(f"{len(leads)} leads, {len(leads) - len(pending)} already called, {len(pending)} to call", file=sys.stderr)
+
+    clips = []
+    for path in args.audio:
+        with open(path, "rb") as f:
+            clips.append(f.read())
+    clips = clips or [synthetic_clip()]
+    base_url = args.base_url
+    if args.mock:
+        base_url = mock_base_url(start_mock_server(MockLatency()))
+    store = open_store(args.session_store)
+    recorder = Recorder()
+    archive = CallArchive(args.archive) if args.archive else None
+    pool = cpu_pool(args.cpu_workers) if {args.stt, args.tts} & {"faster-whisper", "piper"} else None
+
+    async def run(checkpoint):
+        client = openai_client(args.api_key or "mock", base_url, args.max_connections, args.max_connections)
+        engine = TimedEngine(
+            deadlines=StageDeadlines.from_env(),
+            stt=make_stt(args.stt, client, pool, args.stt_model),
+            chat=OpenAIChat(client),
+            tts=make_tts(args.tts, client, pool, args.tts_model, args.tts_format),
+            scheduler=Scheduler.from_env(),
+        )
+        engine.recorder = recorder
+        return await run_campaign(engine, recorder, pending, template, clips, args, store, checkpoint, archive)
+
+    checkpoint = open(args.checkpoint, "a", encoding="utf-8") if args.checkpoint else open(os.devnull, "w")
+    try:
+        elapsed = asyncio.run(run(checkpoint))
+    finally:
+        checkpoint.close()
+        if archive is not None:
+            archive.close()
+        if pool is not None:
+            pool.shutdown()
+    report = recorder.report(elapsed, len(pending), args.turns)
+    report["leads"] = len(leads)
+    report["skipped"] = len(leads) - len(pending)
+    print(format_report(report), file=sys.stderr if args.json == "-" else sys.stdout)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if recorder.completed_calls == len(pending) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
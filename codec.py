@@ -0,0 +1,67 @@
+import io
+
+import numpy as np
+
+from vad import VAD_SAMPLE_RATE, pcm_to_wav
+
+# Speech at 16 kHz mono is intelligible to Whisper well below 24 kbps Opus;
+# the same audio as 16-bit WAV is 256 kbps.
+STT_BITRATE = 24000
+
+# What the speech endpoint can return for each TTS format, as served to the
+# browser.
+TTS_FORMATS = {
+    "mp3": ("audio/mpeg", "mp3"),
+    "opus": ("audio/ogg", "ogg"),
+    "aac": ("audio/aac", "aac"),
+    "flac": ("audio/flac", "flac"),
+    "wav": ("audio/wav", "wav"),
+}
+
+
+def encode_opus(samples, sample_rate=VAD_SAMPLE_RATE, bitrate=STT_BITRATE):
+    # Mono int16 samples to Ogg/Opus bytes.
+    import av
+
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sample_rate, layout="mono")
+        stream.bit_rate = bitrate
+        frame = av.AudioFrame.from_ndarray(
+            np.asarray(samples, dtype=np.int16).reshape(1, -1), format="s16", layout="mono"
+        )
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def decode_pcm(data, sample_rate=VAD_SAMPLE_RATE):
+    # Any container the browser produced (WebM, WAV, Ogg, ...) at any rate
+    # and channel count, downmixed and resampled to mono int16.
+    import av
+
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+    chunks = []
+    with av.open(io.BytesIO(data)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.int16)
+    return np.concatenate(chunks)
+
+
+def encode_for_stt(samples, upload_format="opus", sample_rate=VAD_SAMPLE_RATE):
+    # Returns (bytes, filename); the extension tells the API the format.
+    if upload_format == "opus":
+        return encode_opus(samples, sample_rate), "audio.ogg"
+    return pcm_to_wav(samples, sample_rate), "audio.wav"
+
+
+def transcode_for_stt(data, upload_format="opus"):
+    return encode_for_stt(decode_pcm(data), upload_format)
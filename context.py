@@ -0,0 +1,100 @@
+import threading
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a sales call between an agent (assistant) "
+    "and a lead (user). Update the summary with the new turns. Keep names, answers "
+    "to the script's questions, numbers, objections and agreed next steps. "
+    "Reply with the updated summary only."
+)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# Each prompt re-counts the long system prompt and mostly the same turns as
+# the last one, so counts are kept per text.
+@lru_cache(maxsize=4096)
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if tiktoken is None:
+        # Fallback only (tiktoken is in requirements.txt): close enough for
+        # budgeting English text.
+        return len(text) // 4 + 1
+    return len(_encoding(model).encode(text))
+
+
+def message_tokens(message, model="gpt-3.5-turbo"):
+    # Chat format adds a few tokens of framing per message.
+    return count_tokens(message["content"], model) + 4
+
+
+def summary_request(summary, messages):
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+
+
+class ContextWindow:
+    # Builds the prompt for each turn from a fixed system-prompt prefix, a
+    # rolling summary of older turns and the most recent turns verbatim, kept
+    # under max_tokens. Older turns are folded into the summary in batches so
+    # the prefix changes rarely and provider-side prompt caching keeps hitting.
+
+    def __init__(self, summarize, max_tokens=3000, keep_messages=8, fold_messages=4, model="gpt-3.5-turbo"):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.keep_messages = keep_messages
+        self.fold_messages = fold_messages
+        self.model = model
+        self.summary = ""
+        self.summarized = 0
+        self._lock = threading.Lock()
+        self._fold_lock = threading.Lock()
+
+    def build(self, system_prompt, messages):
+        with self._lock:
+            summary, start = self.summary, self.summarized
+        prefix = [{"role": "system", "content": system_prompt}]
+        if summary:
+            prefix.append({"role": "system", "content": f"Summary of the call so far:\n{summary}"})
+        budget = self.max_tokens - sum(message_tokens(message, self.model) for message in prefix)
+        recent = []
+        for message in reversed(messages[start:]):
+            cost = message_tokens(message, self.model)
+            if recent and cost > budget:
+                break
+            recent.append(message)
+            budget -= cost
+        return prefix + recent[::-1]
+
+    def needs_fold(self, messages):
+        return len(messages) - self.summarized - self.keep_messages >= self.fold_messages
+
+    def unfolded(self, messages):
+        # The turns due to be folded, messages[summarized:end], and end; only
+        # these are read from a lazily loaded history.
+        end = len(messages) - self.keep_messages
+        return messages[self.summarized:end], end
+
+    def fold(self, turns, end):
+        # turns as returned by unfolded(); a fold that finished meanwhile has
+        # already covered the first of them.
+        with self._fold_lock:
+            turns = turns[max(0, len(turns) - (end - self.summarized)):] if end > self.summarized else []
+            if len(turns) < self.fold_messages:
+                return
+            summary = self.summarize(self.summary, turns)
+            with self._lock:
+                self.summary, self.summarized = summary, end
@@ -0,0 +1,288 @@
+import asyncio
+import contextvars
+import os
+import time
+import queue
+import threading
+from dataclasses import dataclass
+
+from context import message_tokens, summary_request
+from metrics import observe, span
+from providers import Fallback, OpenAIChat, OpenAISpeechToText, OpenAITextToSpeech, openai_client
+from scheduler import Scheduler
+from streaming import SentenceChunker
+from tts_cache import tts_key
+
+
+@dataclass
+class StageDeadlines:
+    # Seconds each stage may take before the turn gives up on it.
+    stt: float = 10.0
+    first_token: float = 5.0
+    chat: float = 30.0
+    tts: float = 15.0
+    summary: float = 30.0
+
+    @classmethod
+    def from_env(cls):
+        defaults = cls()
+        return cls(**{
+            name: float(os.getenv(f"{name.upper()}_DEADLINE", getattr(defaults, name)))
+            for name in defaults.__dataclass_fields__
+        })
+
+
+# Completion tokens assumed for a reply when estimating a request's share of
+# the tokens-per-minute limit.
+REPLY_TOKENS = 256
+
+
+async def _in_context(context, coro):
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+class EngineLoop:
+    # One asyncio loop on a daemon thread. The Streamlit script thread and
+    # capture threads hand it coroutines and get concurrent futures back.
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="engine-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        # Carry the caller's context variables (e.g. the current call trace)
+        # over to the task on the loop thread.
+        return asyncio.run_coroutine_threadsafe(_in_context(contextvars.copy_context(), coro), self.loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    def iterate(self, agen, poll=None):
+        # Drive an async generator from sync code. With poll set, yields None
+        # whenever nothing arrived for that long so the caller can do other
+        # work (e.g. pace audio playback) between items.
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((item, None))
+            except BaseException as exc:
+                items.put((done, exc))
+                raise
+            items.put((done, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                try:
+                    item, error = items.get(timeout=poll)
+                except queue.Empty:
+                    yield None
+                    continue
+                if item is done:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+
+class VoiceEngine:
+    # STT, chat and TTS as coroutines, so stages from different turns and
+    # sessions overlap instead of queueing behind each other on a script
+    # thread. Each stage goes through a provider (see providers.py); the
+    # ones not given use OpenAI over one pooled async client. Every provider
+    # call is admitted by the scheduler, which also retries transient errors.
+
+    def __init__(self, api_key=None, base_url=None, max_connections=64, max_keepalive=16,
+                 deadlines=None, chat_model="gpt-3.5-turbo", stt_model="whisper-1",
+                 tts_model="tts-1", tts_format="mp3", tts_cache=None, stt=None, chat=None, tts=None,
+                 scheduler=None):
+        self.client = None
+        if stt is None or chat is None or tts is None:
+            self.client = openai_client(api_key, base_url, max_connections, max_keepalive)
+        self.stt = stt or OpenAISpeechToText(self.client, stt_model)
+        self.chat = chat or OpenAIChat(self.client, chat_model)
+        self.tts = tts or OpenAITextToSpeech(self.client, tts_model, tts_format)
+        self.deadlines = deadlines or StageDeadlines()
+        self.chat_model = self.chat.model
+        self.tts_cache = tts_cache
+        self.scheduler = scheduler or Scheduler()
+
+    def _prompt_tokens(self, messages, reply_tokens=REPLY_TOKENS):
+        # Counted only when there are limits to count against.
+        if not self.scheduler.limits:
+            return 0
+        return sum(message_tokens(message, self.chat_model) for message in messages) + reply_tokens
+
+    def tts_key(self, input_text, voice):
+        return tts_key(input_text, voice, self.tts.model, self.tts.response_format)
+
+    async def _admitted(self, provider, tokens, call):
+        # call(provider) through the scheduler under the provider's model; a
+        # Fallback's providers are admitted one by one, each under its own.
+        if isinstance(provider, Fallback):
+            return await provider.route(lambda inner: self._admitted(inner, tokens, call))
+        return await self.scheduler.call(provider.model, tokens, lambda: call(provider))
+
+    def _admitted_stream(self, provider, tokens, make_stream):
+        if isinstance(provider, Fallback):
+            return provider.route_stream(lambda inner: self._admitted_stream(inner, tokens, make_stream))
+        return self.scheduler.stream(provider.model, tokens, lambda: make_stream(provider))
+
+    async def transcribe(self, audio_data, filename="audio.wav", stage="stt"):
+        with span(stage, bytes=len(audio_data)):
+            return await asyncio.wait_for(
+                self._admitted(self.stt, 0, lambda stt: stt.transcribe(audio_data, filename)),
+                self.deadlines.stt,
+            )
+
+    async def answer(self, messages):
+        with span("chat"):
+            return await asyncio.wait_for(
+                self._admitted(
+                    self.chat, self._prompt_tokens(messages),
+                    lambda chat: chat.complete(messages, temperature=0.7),
+                ),
+                self.deadlines.chat,
+            )
+
+    async def answer_stream(self, messages):
+        # The first token has its own, tighter deadline; the whole reply must
+        # finish within the chat deadline. Time spent waiting for admission
+        # counts towards both.
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        first_token_by = loop.time() + self.deadlines.first_token
+        finish_by = loop.time() + self.deadlines.chat
+        tokens = self._admitted_stream(
+            self.chat, self._prompt_tokens(messages), lambda chat: chat.stream(messages, temperature=0.7)
+        ).__aiter__()
+        limit = min(first_token_by, finish_by)
+        ok = False
+        try:
+            while True:
+                try:
+                    token = await asyncio.wait_for(tokens.__anext__(), limit - loop.time())
+                except StopAsyncIteration:
+                    ok = True
+                    return
+                if limit != finish_by:
+                    observe("first_token", time.perf_counter() - start)
+                    limit = finish_by
+                yield token
+        finally:
+            observe("chat", time.perf_counter() - start, ok=ok)
+            await tokens.aclose()
+
+    async def summarize(self, summary, messages):
+        request = summary_request(summary, messages)
+        return await asyncio.wait_for(
+            self._admitted(
+                self.chat, self._prompt_tokens(request, 300),
+                lambda chat: chat.complete(request, temperature=0, max_tokens=300),
+            ),
+            self.deadlines.summary,
+        )
+
+    async def synthesize(self, input_text, voice):
+        key = self.tts_key(input_text, voice)
+        if self.tts_cache is not None:
+            with span("tts_cache"):
+                data = self.tts_cache.get(key)
+            if data is not None:
+                return data
+        with span("tts", chars=len(input_text)):
+            data = await asyncio.wait_for(
+                self._admitted(self.tts, 0, lambda tts: tts.synthesize(input_text, voice)),
+                self.deadlines.tts,
+            )
+        if self.tts_cache is not None:
+            self.tts_cache.put(key, data)
+        return data
+
+    async def stream_speech(self, input_text, voice, entry):
+        # Fill a media_server.MediaEntry as the TTS response arrives.
+        async def fill():
+            async for chunk in self._admitted_stream(self.tts, 0, lambda tts: tts.stream(input_text, voice)):
+                entry.append(chunk)
+
+        try:
+            with span("tts_stream", chars=len(input_text)):
+                await asyncio.wait_for(fill(), self.deadlines.tts)
+        except BaseException:
+            entry.finish(failed=True)
+            raise
+        entry.finish()
+        if self.tts_cache is not None:
+            self.tts_cache.put(self.tts_key(input_text, voice), entry.data)
+
+    @staticmethod
+    async def _replay(text):
+        yield text
+
+    async def reply_events(self, messages, voice, answer=None):
+        # Yields ("token", text) as the reply streams and ("audio", (sentence,
+        # bytes)) for each sentence, in order. TTS for a sentence starts as soon as the
+        # chunker closes it, while later tokens are still being generated.
+        # With answer given (e.g. a speculative reply) no chat request is made.
+        events = asyncio.Queue()
+        segments = asyncio.Queue()
+
+        async def generate():
+            chunker = SentenceChunker()
+            tokens = self._replay(answer) if answer is not None else self.answer_stream(messages)
+            try:
+                async for token in tokens:
+                    events.put_nowait(("token", token))
+                    for segment in chunker.feed(token):
+                        segments.put_nowait((segment, asyncio.ensure_future(self.synthesize(segment, voice))))
+                for segment in chunker.flush():
+                    segments.put_nowait((segment, asyncio.ensure_future(self.synthesize(segment, voice))))
+            finally:
+                segments.put_nowait(None)
+
+        async def speak():
+            while (item := await segments.get()) is not None:
+                segment, task = item
+                try:
+                    audio = await task
+                except Exception:
+                    # A sentence whose TTS failed (deadline, shed, API error)
+                    # is skipped; its text was shown and the rest is spoken.
+                    continue
+                events.put_nowait(("audio", (segment, audio)))
+
+        async def run():
+            tasks = [asyncio.ensure_future(generate()), asyncio.ensure_future(speak())]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                events.put_nowait(None)
+
+        runner = asyncio.ensure_future(run())
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            await runner
+        finally:
+            runner.cancel()
+            while not segments.empty():
+                item = segments.get_nowait()
+                if item is not None:
+                    _, task = item
+                    task.cancel()
+                    if task.done() and not task.cancelled():
+                        task.exception()
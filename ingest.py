@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+
+from audio_format import VAD_SAMPLE_RATE
+
+# Uploads are raw little-endian 16-bit mono PCM at the VAD rate, no container
+# and no base64:  Content-Type: audio/L16; rate=16000
+INGEST_CONTENT_TYPE = "audio/l16"
+
+
+class IngestSession:
+    # Bounded queue of PCM chunks for one caller. Writers block for up to
+    # put_timeout when it is full (which stops the HTTP handler reading, so
+    # TCP pushes back on the client) and are then refused.
+
+    def __init__(self, session_id, max_chunks=256, put_timeout=2.0, idle_s=2.0):
+        self.session_id = session_id
+        self.put_timeout = put_timeout
+        self.idle_s = idle_s
+        self.uploads = 0
+        self.rejected = 0
+        self.last_active = float("-inf")
+        self.last_seen = time.monotonic()
+        self._chunks = queue.Queue(max_chunks)
+        self._lock = threading.Lock()
+
+    def begin_upload(self):
+        with self._lock:
+            self.uploads += 1
+            self.last_active = time.monotonic()
+
+    def end_upload(self):
+        with self._lock:
+            self.uploads -= 1
+            self.last_active = time.monotonic()
+
+    def put(self, chunk):
+        try:
+            self._chunks.put(chunk, timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        self.last_active = time.monotonic()
+        return True
+
+    def get(self, timeout=None):
+        return self._chunks.get(timeout=timeout)
+
+    def decode(self, chunk):
+        import numpy as np
+
+        return np.frombuffer(chunk, dtype="<i2").astype(np.int16, copy=False)
+
+    @property
+    def queued(self):
+        return self._chunks.qsize()
+
+    @property
+    def started(self):
+        # Anything has been uploaded to this session yet.
+        return self.last_active > float("-inf")
+
+    @property
+    def live(self):
+        # Clients may stream one long chunked POST or send short POSTs back
+        # to back, so a session stays live for idle_s after the last one.
+        return self.uploads > 0 or self.queued > 0 or time.monotonic() - self.last_active < self.idle_s
+
+
+class IngestRegistry:
+    # Sessions by ID. Sessions nobody has touched for ttl seconds are
+    # dropped the next time one is opened.
+
+    def __init__(self, max_chunks=256, put_timeout=2.0, ttl=600.0):
+        self.max_chunks = max_chunks
+        self.put_timeout = put_timeout
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def open(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            for key, session in list(self._sessions.items()):
+                if not session.uploads and now - max(session.last_seen, session.last_active) > self.ttl:
+                    del self._sessions[key]
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = IngestSession(session_id, self.max_chunks, self.put_timeout)
+            session.last_seen = now
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "uploads": sum(session.uploads for session in sessions),
+            "queued_chunks": sum(session.queued for session in sessions),
+            "rejected_chunks": sum(session.rejected for session in sessions),
+        }
+
+
+def parse_content_type(value):
+    # Returns the sample rate of an audio/L16 upload, or None if the body is
+    # in some other format.
+    media_type, _, params = (value or "").partition(";")
+    if media_type.strip().lower() != INGEST_CONTENT_TYPE:
+        return None
+    rate = VAD_SAMPLE_RATE
+    channels = 1
+    for param in params.split(";"):
+        name, _, param_value = param.strip().partition("=")
+        if name.lower() == "rate" and param_value:
+            rate = int(param_value)
+        elif name.lower() == "channels" and param_value:
+            channels = int(param_value)
+    return rate if channels == 1 else None
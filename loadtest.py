@@ -0,0 +1,249 @@
+# Drive N simulated calls through the same STT -> chat -> TTS engine the app
+# uses, by default against a local OpenAI stand-in.
+#   python -m loadtest --calls 50 --turns 4 --json results.json
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from context import ContextWindow
+from engine import StageDeadlines, VoiceEngine
+from mock_openai import MockLatency, mock_base_url, start_mock_server
+from providers import OpenAIChat, cpu_pool, make_stt, make_tts, openai_client
+from scheduler import Scheduler, parse_limits
+from vad import pcm_to_wav
+
+STAGES = ("stt", "first_token", "first_audio", "tts", "reply", "turn")
+SYSTEM_PROMPT = (
+    "Hey {Lead Name}, this is Basit Ali calling from Reactive Space about your recent "
+    "FB Ads inquiry surrounding MetaVerse services. Ask the qualifying questions in order."
+)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest rank: the smallest value with at least q% of samples at or below it.
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.completed_calls = 0
+        self.completed_turns = 0
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def report(self, elapsed, calls, turns):
+        stages = {}
+        for stage in STAGES:
+            values = self.samples.get(stage, [])
+            stages[stage] = {
+                "count": len(values),
+                "errors": self.errors.get(stage, 0),
+                "mean": sum(values) / len(values) if values else None,
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values) if values else None,
+            }
+        return {
+            "calls": calls,
+            "turns_per_call": turns,
+            "elapsed": elapsed,
+            "completed_calls": self.completed_calls,
+            "completed_turns": self.completed_turns,
+            "turns_per_second": self.completed_turns / elapsed if elapsed else 0.0,
+            "calls_per_minute": 60 * self.completed_calls / elapsed if elapsed else 0.0,
+            "stages": stages,
+        }
+
+
+class TimedEngine(VoiceEngine):
+    # Records each TTS request, which reply_events otherwise hides.
+    recorder = None
+
+    async def synthesize(self, input_text, voice):
+        start = time.perf_counter()
+        try:
+            data = await super().synthesize(input_text, voice)
+        except Exception:
+            self.recorder.errors["tts"] += 1
+            raise
+        self.recorder.record("tts", time.perf_counter() - start)
+        return data
+
+
+async def simulate_call(engine, recorder, clips, turns, voice, think, system_prompt=SYSTEM_PROMPT, messages=None):
+    # messages may be any list-like history (e.g. a sessions.History); the
+    # call's turns are appended to it.
+    messages = [] if messages is None else messages
+    context = ContextWindow(None, model=engine.chat_model)
+    ok = True
+    for turn in range(turns):
+        clip = clips[turn % len(clips)]
+        turn_start = time.perf_counter()
+        stage = "stt"
+        try:
+            transcript = await engine.transcribe(clip, "utterance.wav")
+            recorder.record("stt", time.perf_counter() - turn_start)
+            messages.append({"role": "user", "content": transcript})
+            reply = ""
+            first_token = first_audio = None
+            stage = "reply"
+            reply_start = time.perf_counter()
+            async for kind, value in engine.reply_events(context.build(system_prompt, messages), voice):
+                now = time.perf_counter() - reply_start
+                if kind == "token":
+                    reply += value
+                    first_token = first_token if first_token is not None else now
+                elif first_audio is None:
+                    first_audio = now
+            recorder.record("reply", time.perf_counter() - reply_start)
+            if first_token is not None:
+                recorder.record("first_token", first_token)
+            if first_audio is not None:
+                recorder.record("first_audio", first_audio)
+            messages.append({"role": "assistant", "content": reply})
+        except Exception:
+            recorder.errors[stage] += 1
+            recorder.errors["turn"] += 1
+            ok = False
+            continue
+        recorder.record("turn", time.perf_counter() - turn_start)
+        recorder.completed_turns += 1
+        if think:
+            await asyncio.sleep(think)
+    if ok:
+        recorder.completed_calls += 1
+    return ok
+
+
+async def run_load(engine, recorder, clips, calls, turns, voice="onyx", think=0.0, ramp=0.0):
+    async def staggered(index):
+        if ramp:
+            await asyncio.sleep(ramp * index / calls)
+        await simulate_call(engine, recorder, clips, turns, voice, think)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(staggered(index) for index in range(calls)))
+    return time.perf_counter() - start
+
+
+def synthetic_clip(seconds=3.0, sample_rate=16000):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    voice = 3000 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))
+    return pcm_to_wav(voice + rng.normal(0, 200, t.size), sample_rate)
+
+
+def format_report(report):
+    lines = [
+        f"calls: {report['calls']} x {report['turns_per_call']} turns in {report['elapsed']:.2f}s "
+        f"({report['completed_turns']} turns ok, {report['turns_per_second']:.1f} turns/s, "
+        f"{report['calls_per_minute']:.1f} calls/min)",
+        f"{'stage':<12}{'count':>7}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+    ]
+    for stage, stats in report["stages"].items():
+        cells = [f"{stats[key] * 1000:8.0f}ms" if stats[key] is not None else f"{'-':>10}" for key in ("p50", "p95", "p99", "max")]
+        lines.append(f"{stage:<12}{stats['count']:>7}{stats['errors']:>8}" + "".join(cell[-9:] for cell in cells))
+    return "\n".join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load-test the STT -> chat -> TTS pipeline.")
+    parser.add_argument("--calls", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--audio", nargs="*", default=[], help="pre-recorded caller clips, used in rotation")
+    parser.add_argument("--voice", default="onyx")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds between turns")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which calls are started")
+    parser.add_argument("--base-url", help="run against this API instead of the local mock")
+    parser.add_argument("--api-key", default="mock")
+    parser.add_argument("--max-connections", type=int, default=64)
+    parser.add_argument("--stt", default="openai", help="STT provider: openai or faster-whisper")
+    parser.add_argument("--stt-model")
+    parser.add_argument("--tts", default="openai", help="TTS provider: openai, piper or gtts")
+    parser.add_argument("--tts-model", help="model name, or the voice file for piper")
+    parser.add_argument("--tts-format", default="mp3")
+    parser.add_argument("--cpu-workers", type=int, help="process pool size for local providers (default: cores)")
+    parser.add_argument("--mock-stt", type=float, default=MockLatency.stt)
+    parser.add_argument("--mock-first-token", type=float, default=MockLatency.first_token)
+    parser.add_argument("--mock-token", type=float, default=MockLatency.token)
+    parser.add_argument("--mock-tts", type=float, default=MockLatency.tts)
+    parser.add_argument("--mock-jitter", type=float, default=MockLatency.jitter)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--rate-limits", default=os.getenv("RATE_LIMITS"),
+                        help='requests[/tokens] per minute per model, e.g. "gpt-3.5-turbo=3500/90000,tts-1=50"')
+    parser.add_argument("--json", help="write machine-readable results to this path ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    clips = []
+    for path in args.audio:
+        with open(path, "rb") as f:
+            clips.append(f.read())
+    clips = clips or [synthetic_clip()]
+    base_url = args.base_url
+    if base_url is None:
+        server = start_mock_server(MockLatency(
+            stt=args.mock_stt,
+            first_token=args.mock_first_token,
+            token=args.mock_token,
+            tts=args.mock_tts,
+            jitter=args.mock_jitter,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+        ))
+        base_url = mock_base_url(server)
+    recorder = Recorder()
+    pool = cpu_pool(args.cpu_workers) if {args.stt, args.tts} & {"faster-whisper", "piper"} else None
+    scheduler = Scheduler.from_env()
+    scheduler.limits = parse_limits(args.rate_limits)
+
+    async def run():
+        client = openai_client(args.api_key, base_url, args.max_connections, args.max_connections)
+        engine = TimedEngine(
+            deadlines=StageDeadlines.from_env(),
+            stt=make_stt(args.stt, client, pool, args.stt_model),
+            chat=OpenAIChat(client),
+            tts=make_tts(args.tts, client, pool, args.tts_model, args.tts_format),
+            scheduler=scheduler,
+        )
+        engine.recorder = recorder
+        return await run_load(engine, recorder, clips, args.calls, args.turns, args.voice, args.think, args.ramp)
+
+    try:
+        elapsed = asyncio.run(run())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    report = recorder.report(elapsed, args.calls, args.turns)
+    report["base_url"] = base_url
+    report["providers"] = {"stt": args.stt, "tts": args.tts}
+    report["scheduler"] = scheduler.stats()
+    print(format_report(report), file=sys.stderr if args.json == "-" else sys.stdout)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if recorder.completed_turns == args.calls * args.turns else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
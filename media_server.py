@@ -0,0 +1,319 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from audio_format import VAD_SAMPLE_RATE
+from ingest import parse_content_type
+
+CHUNK_SIZE = 16 * 1024
+RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def media_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+class MediaFailed(Exception):
+    # The TTS response behind a clip broke off part way.
+    pass
+
+
+class MediaEntry:
+    # Audio that may still be arriving from the TTS response. Readers that
+    # start early stream the chunks as they are appended.
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.chunks = []
+        self.size = 0
+        self.complete = False
+        self.failed = False
+        self._changed = threading.Condition()
+
+    def append(self, chunk):
+        with self._changed:
+            self.chunks.append(bytes(chunk))
+            self.size += len(chunk)
+            self._changed.notify_all()
+
+    def finish(self, failed=False):
+        with self._changed:
+            self.complete = True
+            self.failed = failed
+            self._changed.notify_all()
+
+    def wait(self, timeout=30):
+        with self._changed:
+            self._changed.wait_for(lambda: self.complete, timeout)
+        return self.complete and not self.failed
+
+    @property
+    def data(self):
+        return b"".join(self.chunks)
+
+    def iter_chunks(self, timeout=30):
+        index = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: index < len(self.chunks) or self.complete, timeout)
+                chunks = self.chunks[index:]
+                done = self.complete
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self.chunks):
+                if self.failed:
+                    raise MediaFailed("media entry failed")
+                return
+            if not chunks:
+                raise TimeoutError("media entry stalled")
+
+
+class MediaStore:
+    # Content-addressed, byte-bounded LRU of audio clips.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def open(self, key, content_type="audio/mpeg"):
+        # Returns (entry, created); only the creator should write to it.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not entry.failed:
+                self._entries.move_to_end(key)
+                return entry, False
+            entry = MediaEntry(content_type)
+            self._entries[key] = entry
+            self._evict()
+            return entry, True
+
+    def put(self, data, content_type="audio/mpeg"):
+        key = media_key(data)
+        entry, created = self.open(key, content_type)
+        if created:
+            entry.append(data)
+            entry.finish()
+            with self._lock:
+                self._evict()
+        return key
+
+    def _evict(self):
+        total = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.complete:
+                total -= entry.size
+                del self._entries[key]
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+    metrics = None
+    ingest = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics" and self.metrics is not None:
+            body = self.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        match = re.fullmatch(r"/media/([0-9a-f]+)(?:\.\w+)?", self.path.split("?")[0])
+        entry = self.store.get(match.group(1)) if match else None
+        if entry is None or entry.failed:
+            self.send_error(404)
+            return
+        key = match.group(1)
+        if self.headers.get("If-None-Match") == f'"{key}"':
+            self.send_response(304)
+            self._send_cache_headers(key)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        range_header = self.headers.get("Range")
+        # <audio> elements ask for "bytes=0-" even on first load; for a clip
+        # still arriving that is the whole clip, so it is streamed (a server
+        # may ignore Range). Other ranges wait for the clip to finish.
+        if range_header and re.fullmatch(r"\s*bytes=0-\s*", range_header) and not entry.complete:
+            range_header = None
+        if range_header or entry.complete:
+            if not entry.wait():
+                self.send_error(404)
+                return
+            self._send_complete(key, entry, range_header)
+        else:
+            self._send_streaming(key, entry)
+
+    def do_OPTIONS(self):
+        # CORS preflight for uploads from the Streamlit page.
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        # POST /ingest/<session id> with raw PCM (see ingest.py), either as
+        # one long chunked upload or as short bodies back to back.
+        match = re.fullmatch(r"/ingest/([\w-]+)", self.path.split("?")[0])
+        session = self.ingest.get(match.group(1)) if match and self.ingest is not None else None
+        if session is None:
+            self._send_empty(404, close=True)
+            return
+        try:
+            rate = parse_content_type(self.headers.get("Content-Type"))
+        except ValueError:
+            rate = None
+        if rate != VAD_SAMPLE_RATE:
+            self._send_empty(415, close=True)
+            return
+        session.begin_upload()
+        try:
+            accepted = self._ingest_body(session)
+        finally:
+            session.end_upload()
+        if accepted:
+            self._send_empty(204)
+        else:
+            self._send_empty(503, close=True, retry_after=1)
+
+    def _ingest_body(self, session):
+        # Chunks are forwarded as they arrive, cut on sample boundaries.
+        # False if the session's queue stayed full; the rest of the body is
+        # then not read and the connection is closed.
+        carry = b""
+        for piece in self._read_body():
+            data = carry + piece
+            cut = len(data) - len(data) % 2
+            carry = data[cut:]
+            if cut and not session.put(data[:cut]):
+                return False
+        return True
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                while size:
+                    piece = self.rfile.read(min(size, CHUNK_SIZE))
+                    if not piece:
+                        raise ConnectionError("upload ended mid-chunk")
+                    size -= len(piece)
+                    yield piece
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            piece = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not piece:
+                raise ConnectionError("upload ended early")
+            remaining -= len(piece)
+            yield piece
+
+    def _send_empty(self, status, close=False, retry_after=None):
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        if close:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_cache_headers(self, key):
+        self.send_header("ETag", f'"{key}"')
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.send_header("Access-Control-Allow-Origin", "*")
+
+    def _send_complete(self, key, entry, range_header):
+        data = memoryview(entry.data)
+        start, end = 0, len(data) - 1
+        status = 200
+        if range_header:
+            match = RANGE_HEADER.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else end
+                else:
+                    start = max(0, len(data) - int(match.group(2)))
+                end = min(end, len(data) - 1)
+                status = 206
+            if status == 206 and start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self._send_cache_headers(key)
+        self.send_header("Content-Type", entry.content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        for offset in range(start, end + 1, CHUNK_SIZE):
+            self.wfile.write(data[offset:min(offset + CHUNK_SIZE, end + 1)])
+
+    def _send_streaming(self, key, entry):
+        # The clip is still being synthesized: send what we have and keep
+        # going with chunked transfer so the browser can start playing. The
+        # clip may yet fail, so this response is not cached; if it does, the
+        # connection is dropped without the last chunk, which the browser
+        # sees as a truncated body rather than a complete clip.
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Type", entry.content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in entry.iter_chunks():
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+        except (TimeoutError, MediaFailed):
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_media_server(store, host="0.0.0.0", port=8502, metrics=None, ingest=None):
+    # metrics, if given, is a metrics.Registry served at /metrics; ingest an
+    # ingest.IngestRegistry whose sessions accept audio at /ingest/<id>.
+    handler = type("BoundMediaRequestHandler", (MediaRequestHandler,), {
+        "store": store,
+        "metrics": metrics,
+        "ingest": ingest,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,170 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger("agent.metrics")
+
+# The call/turn being worked on. Set it on the script or capture thread; the
+# engine loop picks it up because EngineLoop.submit carries context across.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class TurnTrace:
+    def __init__(self, call_id, turn=None):
+        self.call_id = call_id
+        self.turn = turn
+        self.spans = []
+
+    def totals(self):
+        totals = {}
+        for stage, seconds, _ in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Registry:
+    # Per-stage latency histograms and error counters in Prometheus text
+    # format. Call IDs only go to the JSON log, not to metric labels, to keep
+    # series cardinality bounded.
+
+    def __init__(self):
+        self._histograms = {}
+        self._errors = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, ok=True):
+        with self._lock:
+            self._histograms.setdefault(stage, Histogram()).observe(seconds)
+            if not ok:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    def count(self, name, outcome=None):
+        with self._lock:
+            key = (name, outcome)
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def register_collector(self, name, collect):
+        # collect() returns a {metric_suffix: number} dict of gauges.
+        self._collectors.append((name, collect))
+
+    def render(self):
+        lines = [
+            "# HELP agent_stage_seconds Latency of each pipeline stage.",
+            "# TYPE agent_stage_seconds histogram",
+        ]
+        with self._lock:
+            histograms = {stage: (list(h.counts), h.sum, h.count) for stage, h in self._histograms.items()}
+            errors = dict(self._errors)
+            counters = dict(self._counters)
+        for stage, (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'agent_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'agent_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'agent_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += [
+            "# HELP agent_stage_errors_total Failed pipeline stages.",
+            "# TYPE agent_stage_errors_total counter",
+        ]
+        for stage, count in sorted(errors.items()):
+            lines.append(f'agent_stage_errors_total{{stage="{stage}"}} {count}')
+        named = None
+        for (name, outcome), count in sorted(counters.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+            if name != named:
+                lines.append(f"# TYPE agent_{name}_total counter")
+                named = name
+            labels = f'{{outcome="{outcome}"}}' if outcome is not None else ""
+            lines.append(f"agent_{name}_total{labels} {count}")
+        for name, collect in self._collectors:
+            for suffix, value in sorted(collect().items()):
+                lines.append(f"# TYPE agent_{name}_{suffix} gauge")
+                lines.append(f"agent_{name}_{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def observe(stage, seconds, ok=True, **fields):
+    trace = current_trace.get()
+    registry.observe(stage, seconds, ok)
+    if trace is not None:
+        trace.spans.append((stage, seconds, ok))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            "event": "span",
+            "stage": stage,
+            "call_id": trace.call_id if trace else None,
+            "turn": trace.turn if trace else None,
+            "duration_ms": round(seconds * 1000, 2),
+            "ok": ok,
+            "ts": time.time(),
+            **fields,
+        }))
+
+
+def count(name, outcome=None, **fields):
+    # Events that are not stages (a barge-in, a speculative reply used or
+    # thrown away) are counted on their own, not as stage latencies or errors.
+    trace = current_trace.get()
+    registry.count(name, outcome)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            "event": name,
+            "outcome": outcome,
+            "call_id": trace.call_id if trace else None,
+            "turn": trace.turn if trace else None,
+            "ts": time.time(),
+            **fields,
+        }))
+
+
+@contextmanager
+def span(stage, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe(stage, time.perf_counter() - start, ok=False, **fields)
+        raise
+    observe(stage, time.perf_counter() - start, **fields)
+
+
+@contextmanager
+def tracing(trace):
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+
+def configure_json_logging(stream=None, level=logging.INFO):
+    if not logger.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
@@ -0,0 +1,174 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "That's great to hear. So the purpose of my call is your recent inquiry about MetaVerse services. "
+    "Do you have fifteen minutes now for a quick conversation about your goals?"
+)
+
+
+@dataclass
+class MockLatency:
+    # Seconds; each delay is scaled by a random factor in [1 - jitter, 1 + jitter].
+    stt: float = 0.3
+    first_token: float = 0.25
+    token: float = 0.02
+    tts: float = 0.2
+    jitter: float = 0.2
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients that hit their deadline hang up mid-response; that is
+        # expected under load and not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    # Stand-in for the transcription, chat and speech endpoints, for load
+    # tests that must not spend money or depend on the network.
+    protocol_version = "HTTP/1.1"
+    latency = MockLatency()
+    reply = DEFAULT_REPLY
+    transcript = "Yes, I remember booking it. I want to sell ten products this year."
+
+    def log_message(self, format, *args):
+        pass
+
+    def _sleep(self, seconds):
+        jitter = self.latency.jitter
+        time.sleep(max(0.0, seconds * random.uniform(1 - jitter, 1 + jitter)))
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split("?")[0].rstrip("/")
+        if random.random() < self.latency.error_rate:
+            self._sleep(self.latency.first_token)
+            error = {"error": {"message": "injected failure", "type": "server_error", "code": None}}
+            self._send(self.latency.error_status, json.dumps(error).encode())
+            return
+        if path.endswith("/audio/transcriptions"):
+            self._sleep(self.latency.stt)
+            self._send(200, self.transcript.encode(), "text/plain")
+        elif path.endswith("/audio/speech"):
+            request = json.loads(body or b"{}")
+            text = request.get("input", "")
+            self._sleep(self.latency.tts)
+            # Roughly the size of a 160 kbps MP3 (or ~32 kbps Opus) at ~15
+            # characters per second.
+            if request.get("response_format") == "opus":
+                self._send(200, b"OggS" * (len(text) * 67 + 1), "audio/ogg")
+            else:
+                self._send(200, b"\xff\xfb" * (len(text) * 670 + 1), "audio/mpeg")
+        elif path.endswith("/chat/completions"):
+            request = json.loads(body or b"{}")
+            if request.get("stream"):
+                self._stream_chat(request)
+            else:
+                self._sleep(self.latency.first_token + self.latency.token * len(self.reply.split()))
+                self._send(200, json.dumps(self._completion(request, self.reply)).encode())
+        else:
+            self._send(404, b'{"error": {"message": "not found"}}')
+
+    def _completion(self, request, content):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _stream_chat(self, request):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._sleep(self.latency.first_token)
+        words = self.reply.split(" ")
+        for index, word in enumerate(words):
+            if index:
+                self._sleep(self.latency.token)
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": word + (" " if index < len(words) - 1 else "")}, "finish_reason": None}],
+            }
+            self._chunk(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+        self._chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_server(latency=None, host="127.0.0.1", port=0, reply=DEFAULT_REPLY):
+    handler = type("BoundMockOpenAIHandler", (MockOpenAIHandler,), {
+        "latency": latency or MockLatency(),
+        "reply": reply,
+    })
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def mock_base_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def main(argv=None):
+    # Run the stand-in on its own so load tests do not share a process (and
+    # a GIL) with it:  python -m mock_openai --port 8600
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI audio and chat endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    for name, default in MockLatency().__dict__.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args(argv)
+    latency = MockLatency(**{name: getattr(args, name) for name in MockLatency().__dict__})
+    server = start_mock_server(latency, args.host, args.port)
+    print(f"mock OpenAI API at {mock_base_url(server)}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
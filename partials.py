@@ -0,0 +1,80 @@
+import re
+
+WORD = re.compile(r"[\w']+")
+
+
+def normalize_word(word):
+    return "".join(WORD.findall(word.lower()))
+
+
+def same_transcript(a, b):
+    # Equal up to case, punctuation and spacing.
+    return [normalize_word(w) for w in a.split()] == [normalize_word(w) for w in b.split()]
+
+
+def stitch(words, new_words, max_skip=2):
+    # Append the transcript of a later, overlapping window. The longest run
+    # shared by the tail of words and the head of new_words is the overlap;
+    # up to max_skip words at either edge are ignored because a window
+    # boundary can cut a word in half and garble it. Past the overlap the
+    # newer window wins.
+    old = [normalize_word(w) for w in words]
+    new = [normalize_word(w) for w in new_words]
+    best = None
+    for j in range(min(max_skip, len(new)) + 1):
+        for i in range(max(0, len(old) - len(new) - max_skip), len(old)):
+            size = 0
+            while i + size < len(old) and j + size < len(new) and old[i + size] == new[j + size]:
+                size += 1
+            if size and i + size >= len(old) - max_skip and (best is None or size > best[2]):
+                best = (i, j, size)
+    if best is None:
+        return words + new_words
+    i, j, size = best
+    return words[:i + size] + new_words[j + size:]
+
+
+class PartialTranscriber:
+    # Schedules overlapping windows over the utterance that is still being
+    # spoken and stitches their transcripts together. One extra window is
+    # taken as soon as the caller pauses; its transcript is "stable" if no
+    # speech followed it, which is when a reply can be started speculatively.
+
+    def __init__(self, sample_rate, window_s=4.0, step_s=1.0, pause_ms=160):
+        self.window = int(window_s * sample_rate)
+        self.step = int(step_s * sample_rate)
+        self.pause_ms = pause_ms
+        self.reset()
+
+    def reset(self):
+        self.words = []
+        self._issued_end = 0
+        self._paused = False
+
+    @property
+    def text(self):
+        return " ".join(self.words)
+
+    def next_window(self, buffered, silence_ms):
+        # Returns (start, end, pause) in samples of the utterance buffer, or
+        # None if no window is due yet.
+        if silence_ms >= self.pause_ms:
+            if self._paused or buffered <= self._issued_end:
+                return None
+            self._paused = True
+        else:
+            self._paused = False
+            if buffered - self._issued_end < self.step:
+                return None
+        self._issued_end = buffered
+        return max(0, buffered - self.window), buffered, self._paused
+
+    def update(self, window, transcript):
+        # Apply window transcripts in the order the windows were issued.
+        # Returns the stitched text if it is stable, else None.
+        start, end, pause = window
+        new_words = transcript.split()
+        self.words = new_words if start == 0 else stitch(self.words, new_words)
+        if pause and end == self._issued_end and self.words:
+            return self.text
+        return None
@@ -0,0 +1,255 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+from codec import decode_pcm, encode_opus
+from media_server import CHUNK_SIZE
+
+# Each stage is one small interface:
+#   SpeechToText.transcribe(audio_data, filename) -> str
+#   ChatModel.complete(messages, ...) -> str, ChatModel.stream(messages, ...) -> async iter of str
+#   TextToSpeech.synthesize(text, voice) -> bytes, TextToSpeech.stream(text, voice) -> async iter of bytes
+# Every provider has a model name; TTS providers also say which format they
+# return. Local backends do their inference in a process pool so it never
+# runs on the engine loop or a script thread. The OpenAI SDK is imported
+# when the first client is made; it is most of the app's import time.
+
+
+def openai_client(api_key=None, base_url=None, max_connections=64, max_keepalive=16):
+    import httpx
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
+    )
+
+
+def cpu_pool(workers=None):
+    # Sized to the cores by default. Spawned, not forked: the parent has the
+    # engine loop, the media server and Streamlit's threads running.
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+
+class OpenAISpeechToText:
+    def __init__(self, client, model="whisper-1"):
+        self.client = client
+        self.model = model
+
+    async def transcribe(self, audio_data, filename="audio.wav"):
+        return await self.client.audio.transcriptions.create(
+            model=self.model,
+            response_format="text",
+            file=(filename, audio_data),
+        )
+
+
+class OpenAIChat:
+    # Any OpenAI-compatible endpoint: the API itself, or a local server
+    # (llama.cpp, Ollama, vLLM) given its base_url.
+
+    def __init__(self, client, model="gpt-3.5-turbo"):
+        self.client = client
+        self.model = model
+
+    async def complete(self, messages, temperature=0.7, max_tokens=None):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            temperature=temperature,
+            messages=messages,
+            **({"max_tokens": max_tokens} if max_tokens else {}),
+        )
+        return response.choices[0].message.content
+
+    async def stream(self, messages, temperature=0.7):
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            temperature=temperature,
+            messages=messages,
+            stream=True,
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+class OpenAITextToSpeech:
+    def __init__(self, client, model="tts-1", response_format="mp3"):
+        self.client = client
+        self.model = model
+        self.response_format = response_format
+
+    async def synthesize(self, text, voice):
+        response = await self.client.audio.speech.create(
+            model=self.model, voice=voice, input=text, response_format=self.response_format
+        )
+        return response.content
+
+    async def stream(self, text, voice):
+        async with self.client.audio.speech.with_streaming_response.create(
+            model=self.model, voice=voice, input=text, response_format=self.response_format
+        ) as response:
+            async for chunk in response.iter_bytes(CHUNK_SIZE):
+                yield chunk
+
+
+# Worker-side state: each pool process loads a model once and keeps it.
+_local_models = {}
+
+
+def _whisper_transcribe(model, audio_data):
+    from faster_whisper import WhisperModel
+
+    if ("whisper", model) not in _local_models:
+        # One inference thread per worker; the pool provides the parallelism.
+        _local_models["whisper", model] = WhisperModel(model, device="cpu", compute_type="int8", cpu_threads=1)
+    segments, _ = _local_models["whisper", model].transcribe(io.BytesIO(audio_data), beam_size=1)
+    return " ".join(segment.text.strip() for segment in segments)
+
+
+def _piper_synthesize(model, text, response_format):
+    from piper.voice import PiperVoice
+
+    if ("piper", model) not in _local_models:
+        _local_models["piper", model] = PiperVoice.load(model)
+    voice = _local_models["piper", model]
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        # piper-tts renamed synthesize() to synthesize_wav() in 1.3.
+        (getattr(voice, "synthesize_wav", None) or voice.synthesize)(text, wav)
+    if response_format == "opus":
+        return encode_opus(decode_pcm(buffer.getvalue(), 24000), 24000, 32000)
+    return buffer.getvalue()
+
+
+class LocalWhisperSpeechToText:
+    # faster-whisper on the CPU (pip install faster-whisper).
+
+    def __init__(self, pool, model="base.en"):
+        self.pool = pool
+        self.model = model
+
+    async def transcribe(self, audio_data, filename="audio.wav"):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _whisper_transcribe, self.model, audio_data)
+
+
+class PiperTextToSpeech:
+    # Piper voices on the CPU (pip install piper-tts); model is the path of
+    # a .onnx voice. The voice argument is ignored: the model is the voice.
+
+    def __init__(self, pool, model, response_format="opus"):
+        if response_format not in ("opus", "wav"):
+            raise ValueError(f"piper output can be opus or wav, not {response_format}")
+        self.pool = pool
+        self.model = model
+        self.response_format = response_format
+
+    async def synthesize(self, text, voice):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _piper_synthesize, self.model, text, self.response_format)
+
+    async def stream(self, text, voice):
+        yield await self.synthesize(text, voice)
+
+
+class GTTSTextToSpeech:
+    # Google Translate's TTS through gTTS, as in the earlier version of the
+    # app. It is a blocking HTTP call, so it runs on a thread, not the pool.
+    response_format = "mp3"
+
+    def __init__(self, lang="en"):
+        self.lang = lang
+        self.model = f"gtts-{lang}"
+
+    def _synthesize(self, text):
+        from gtts import gTTS
+
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=self.lang).write_to_fp(buffer)
+        return buffer.getvalue()
+
+    async def synthesize(self, text, voice):
+        return await asyncio.to_thread(self._synthesize, text)
+
+    async def stream(self, text, voice):
+        yield await self.synthesize(text, voice)
+
+
+class Fallback:
+    # Tries the primary provider and moves to the fallback when it fails or
+    # has not answered (or, for streams, produced its first item) within
+    # after seconds. For text-producing stages; TTS providers differ in
+    # voice and format, so they are chosen by config instead.
+
+    # route() and route_stream() take the call to make on a provider, so a
+    # caller can wrap each provider's own call (the engine admits each one
+    # under its own model, and a primary that is shed falls back at once).
+
+    def __init__(self, primary, fallback, after=3.0):
+        self.primary = primary
+        self.fallback = fallback
+        self.after = after
+        self.model = primary.model
+
+    async def route(self, call):
+        try:
+            return await asyncio.wait_for(call(self.primary), self.after)
+        except Exception:
+            return await call(self.fallback)
+
+    async def route_stream(self, make_stream):
+        items = make_stream(self.primary).__aiter__()
+        try:
+            first = await asyncio.wait_for(items.__anext__(), self.after)
+        except StopAsyncIteration:
+            return
+        except Exception:
+            await items.aclose()
+            async for item in make_stream(self.fallback):
+                yield item
+            return
+        yield first
+        async for item in items:
+            yield item
+
+    async def transcribe(self, audio_data, filename="audio.wav"):
+        return await self.route(lambda provider: provider.transcribe(audio_data, filename))
+
+    async def complete(self, messages, temperature=0.7, max_tokens=None):
+        return await self.route(lambda provider: provider.complete(messages, temperature, max_tokens))
+
+    def stream(self, messages, temperature=0.7):
+        return self.route_stream(lambda provider: provider.stream(messages, temperature))
+
+
+def make_stt(name, client=None, pool=None, model=None):
+    if name == "openai":
+        return OpenAISpeechToText(client, model or "whisper-1")
+    if name == "faster-whisper":
+        return LocalWhisperSpeechToText(pool, model or "base.en")
+    raise ValueError(f"unknown STT provider {name!r}")
+
+
+def make_tts(name, client=None, pool=None, model=None, response_format="mp3"):
+    if name == "openai":
+        return OpenAITextToSpeech(client, model or "tts-1", response_format)
+    if name == "piper":
+        if not model:
+            raise ValueError("the piper provider needs the path of a voice model")
+        # Piper cannot make MP3; Opus is the compact alternative.
+        return PiperTextToSpeech(pool, model, response_format if response_format in ("opus", "wav") else "opus")
+    if name == "gtts":
+        return GTTSTextToSpeech()
+    raise ValueError(f"unknown TTS provider {name!r}")
@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+
+from metrics import observe
+
+# Priority classes, most urgent first. The class travels with the caller's
+# context (EngineLoop.submit carries it over), like the call trace.
+LIVE, SPECULATIVE, PREWARM, BACKGROUND = range(4)
+PRIORITY_NAMES = ("live", "speculative", "prewarm", "background")
+current_priority = contextvars.ContextVar("current_priority", default=LIVE)
+
+# Longest a request of each class may wait for admission before it is shed.
+# A live turn is not worth answering late; a prewarm or a summary can wait.
+DEFAULT_BUDGETS = {LIVE: 3.0, SPECULATIVE: 0.5, PREWARM: 30.0, BACKGROUND: 60.0}
+
+
+class Overloaded(asyncio.TimeoutError):
+    # Raised instead of queueing a request that would wait past its class's
+    # budget; callers treat it like any other stage deadline.
+    pass
+
+
+@contextmanager
+def prioritized(level):
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    # Refills at per_minute / 60 a second up to burst_s seconds' worth. A
+    # request larger than the bucket is admitted once it is full, leaving it
+    # in debt, so big prompts are slowed down rather than refused.
+
+    def __init__(self, per_minute, burst_s=10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_s)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        # Until a single request of this size may go.
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def drain_time(self, amount, now):
+        # Until this much queued demand has been let through, uncapped.
+        self._refill(now)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+
+def parse_limits(spec):
+    # "gpt-3.5-turbo=3500/90000,whisper-1=50,tts-1=50": requests (and
+    # optionally tokens) per minute for each model.
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition("/")
+        limits[model.strip()] = (float(rpm) if rpm else None, float(tpm) if tpm else None)
+    return limits
+
+
+class _ModelQueue:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waiters = []
+        self.wakeup = asyncio.Event()
+        self.pump = None
+
+    def delay(self, requests, tokens, now):
+        delay = 0.0
+        if self.requests is not None:
+            delay = self.requests.delay(requests, now)
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    def drain_time(self, requests, tokens, now):
+        drain = 0.0
+        if self.requests is not None:
+            drain = self.requests.drain_time(requests, now)
+        if self.tokens is not None and tokens:
+            drain = max(drain, self.tokens.drain_time(tokens, now))
+        return drain
+
+    def take(self, tokens, now):
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None and tokens:
+            self.tokens.take(tokens, now)
+
+
+class Scheduler:
+    # Admission control in front of every provider call, per model: token
+    # buckets for requests and estimated tokens per minute, a priority queue
+    # per model so live turns go first, load shedding past each class's wait
+    # budget, and jittered exponential backoff for retryable API errors.
+    # Lives on the engine loop; models without limits are admitted at once.
+
+    def __init__(self, limits=None, budgets=None, max_attempts=3, backoff=0.25, backoff_cap=4.0):
+        self.limits = limits or {}
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.shed = 0
+        self.retries = 0
+        self._queues = {}
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_env(cls):
+        budgets = {
+            level: float(os.getenv(f"SHED_{name.upper()}_AFTER", DEFAULT_BUDGETS[level]))
+            for level, name in enumerate(PRIORITY_NAMES)
+        }
+        return cls(
+            limits=parse_limits(os.getenv("RATE_LIMITS")),
+            budgets=budgets,
+            max_attempts=int(os.getenv("API_MAX_ATTEMPTS", "3")),
+        )
+
+    def _queue(self, model):
+        if model not in self.limits:
+            return None
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(*self.limits[model])
+        return queue
+
+    def _estimate_wait(self, queue, level, tokens, now):
+        # Time until everything queued ahead of this request has gone through
+        # the buckets, then until the request itself fits.
+        ahead = [waiter for waiter in queue.waiters if waiter[0] <= level and not waiter[2].done()]
+        if not ahead:
+            return queue.delay(1, tokens, now)
+        requests, queued_tokens = len(ahead), sum(waiter[3] for waiter in ahead)
+        drain = queue.drain_time(requests, queued_tokens, now)
+        own = 0.0
+        if queue.requests is not None:
+            own = 1 / queue.requests.rate
+        if queue.tokens is not None and tokens:
+            own = max(own, min(tokens, queue.tokens.capacity) / queue.tokens.rate)
+        return drain + own
+
+    async def admit(self, model, tokens=0):
+        queue = self._queue(model)
+        if queue is None:
+            return
+        level = current_priority.get()
+        budget = self.budgets[level]
+        now = time.monotonic()
+        if not queue.waiters and queue.delay(1, tokens, now) == 0:
+            queue.take(tokens, now)
+            return
+        if self._estimate_wait(queue, level, tokens, now) > budget:
+            self.shed += 1
+            observe("queue_wait", 0.0, ok=False, model=model, priority=PRIORITY_NAMES[level], shed=True)
+            raise Overloaded(f"{model}: {PRIORITY_NAMES[level]} request would wait over {budget:g}s")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue.waiters, (level, next(self._sequence), future, tokens, now + budget))
+        queue.wakeup.set()
+        if queue.pump is None or queue.pump.done():
+            queue.pump = asyncio.ensure_future(self._pump(model, queue))
+        try:
+            await future
+        except Overloaded:
+            observe("queue_wait", time.monotonic() - now, ok=False, model=model, priority=PRIORITY_NAMES[level])
+            raise
+        observe("queue_wait", time.monotonic() - now, model=model, priority=PRIORITY_NAMES[level])
+
+    async def _pump(self, model, queue):
+        while queue.waiters:
+            level, _, future, tokens, deadline = queue.waiters[0]
+            now = time.monotonic()
+            if future.done():
+                heapq.heappop(queue.waiters)
+                continue
+            if now >= deadline:
+                # Overtaken by more urgent work for longer than its budget.
+                heapq.heappop(queue.waiters)
+                self.shed += 1
+                future.set_exception(Overloaded(f"{model}: {PRIORITY_NAMES[level]} request waited {self.budgets[level]:g}s"))
+                continue
+            delay = queue.delay(1, tokens, now)
+            if delay == 0:
+                heapq.heappop(queue.waiters)
+                queue.take(tokens, now)
+                future.set_result(None)
+                continue
+            queue.wakeup.clear()
+            try:
+                await asyncio.wait_for(queue.wakeup.wait(), min(delay, deadline - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def retry_delay(self, error, attempt):
+        # None if the error is not worth retrying or attempts are used up.
+        import openai
+
+        retryable = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+        if attempt + 1 >= self.max_attempts or not isinstance(error, retryable):
+            return None
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def call(self, model, tokens, make_call):
+        attempt = 0
+        while True:
+            await self.admit(model, tokens)
+            try:
+                return await make_call()
+            except Exception as error:
+                delay = self.retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, model, tokens, make_stream):
+        # Retries only until the first item; after that a failure is the
+        # caller's to handle, as part of the reply has been used already.
+        attempt = 0
+        while True:
+            await self.admit(model, tokens)
+            items = make_stream().__aiter__()
+            try:
+                first = await items.__anext__()
+                break
+            except StopAsyncIteration:
+                return
+            except Exception as error:
+                await items.aclose()
+                delay = self.retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+        try:
+            yield first
+            async for item in items:
+                yield item
+        finally:
+            await items.aclose()
+
+    def stats(self):
+        stats = {"shed_total": self.shed, "retries_total": self.retries}
+        for model, queue in list(self._queues.items()):
+            stats[f"queued_{re.sub(r'[^0-9A-Za-z]+', '_', model)}"] = sum(
+                not waiter[2].done() for waiter in queue.waiters
+            )
+        return stats
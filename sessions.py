@@ -0,0 +1,240 @@
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import Sequence
+
+# One record per message: a byte holding the role (and a compression flag)
+# followed by the UTF-8 text, zlib-compressed when that makes it smaller.
+# Turns are appended one record at a time, never rewritten.
+ROLES = ("user", "assistant", "system")
+COMPRESSED = 0x80
+COMPRESS_OVER = 200
+
+
+def encode_message(message):
+    body = message["content"].encode("utf-8")
+    flags = ROLES.index(message["role"])
+    if len(body) > COMPRESS_OVER:
+        packed = zlib.compress(body, 6)
+        if len(packed) < len(body):
+            body, flags = packed, flags | COMPRESSED
+    return bytes([flags]) + body
+
+
+def decode_message(record):
+    body = record[1:]
+    if record[0] & COMPRESSED:
+        body = zlib.decompress(body)
+    return {"role": ROLES[record[0] & ~COMPRESSED], "content": bytes(body).decode("utf-8")}
+
+
+# A session store keeps each call's messages and its rolling summary:
+#   append(call_id, message) -> index of the new message
+#   count(call_id) -> number of messages
+#   load(call_id, start=0, stop=None) -> messages[start:stop]
+#   save_summary(call_id, summary, summarized), load_summary(call_id) -> (summary, summarized)
+#   delete(call_id)
+
+
+class SQLiteSessionStore:
+    # Local store; WAL mode lets reads carry on while a turn is written.
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " call_id TEXT NOT NULL, seq INTEGER NOT NULL, record BLOB NOT NULL,"
+                " PRIMARY KEY (call_id, seq)) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS calls ("
+                " call_id TEXT PRIMARY KEY, summary BLOB, summarized INTEGER NOT NULL DEFAULT 0,"
+                " updated REAL NOT NULL)"
+            )
+
+    def append(self, call_id, message):
+        with self._lock:
+            (seq,) = self._db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE call_id = ?", (call_id,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT INTO turns (call_id, seq, record) VALUES (?, ?, ?)",
+                (call_id, seq, encode_message(message)),
+            )
+        return seq
+
+    def count(self, call_id):
+        with self._lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM turns WHERE call_id = ?", (call_id,)).fetchone()
+        return count
+
+    def load(self, call_id, start=0, stop=None):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT record FROM turns WHERE call_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (call_id, start, stop if stop is not None else 2**62),
+            ).fetchall()
+        return [decode_message(record) for (record,) in rows]
+
+    def save_summary(self, call_id, summary, summarized):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO calls (call_id, summary, summarized, updated) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (call_id) DO UPDATE SET"
+                " summary = excluded.summary, summarized = excluded.summarized, updated = excluded.updated",
+                (call_id, zlib.compress(summary.encode("utf-8")), summarized, time.time()),
+            )
+
+    def load_summary(self, call_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary, summarized FROM calls WHERE call_id = ?", (call_id,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return "", 0
+        return zlib.decompress(row[0]).decode("utf-8"), row[1]
+
+    def delete(self, call_id):
+        with self._lock:
+            self._db.execute("DELETE FROM turns WHERE call_id = ?", (call_id,))
+            self._db.execute("DELETE FROM calls WHERE call_id = ?", (call_id,))
+
+
+class KeyValueSessionStore:
+    # The same store over a Redis-like client: messages are a list
+    # (RPUSH/LRANGE/LLEN) and the summary a hash (HSET/HGETALL), so a
+    # redis.Redis instance shared by every replica works as is.
+
+    def __init__(self, client, prefix="call:"):
+        self.client = client
+        self.prefix = prefix
+
+    def append(self, call_id, message):
+        return self.client.rpush(f"{self.prefix}{call_id}:turns", encode_message(message)) - 1
+
+    def count(self, call_id):
+        return self.client.llen(f"{self.prefix}{call_id}:turns")
+
+    def load(self, call_id, start=0, stop=None):
+        end = -1 if stop is None else stop - 1
+        if stop is not None and stop <= start:
+            return []
+        return [decode_message(record) for record in self.client.lrange(f"{self.prefix}{call_id}:turns", start, end)]
+
+    def save_summary(self, call_id, summary, summarized):
+        self.client.hset(f"{self.prefix}{call_id}:summary", mapping={
+            "summary": zlib.compress(summary.encode("utf-8")),
+            "summarized": summarized,
+        })
+
+    def load_summary(self, call_id):
+        fields = self.client.hgetall(f"{self.prefix}{call_id}:summary")
+        if not fields:
+            return "", 0
+        fields = {key.decode() if isinstance(key, bytes) else key: value for key, value in fields.items()}
+        return zlib.decompress(fields["summary"]).decode("utf-8"), int(fields["summarized"])
+
+    def delete(self, call_id):
+        self.client.delete(f"{self.prefix}{call_id}:turns", f"{self.prefix}{call_id}:summary")
+
+
+class MemoryKeyValue:
+    # In-process stand-in for the handful of Redis commands the store uses,
+    # for tests and single-process runs.
+
+    def __init__(self):
+        self._lists = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def rpush(self, key, *values):
+        with self._lock:
+            items = self._lists.setdefault(key, [])
+            items.extend(values)
+            return len(items)
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._lists.get(key, ()))
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._lists.get(key, [])
+            return items[start:None if end == -1 else end + 1]
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self._hashes.setdefault(key, {}).update(mapping)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._lists.pop(key, None)
+                self._hashes.pop(key, None)
+
+
+def open_store(url):
+    # sqlite:///path/to.db, memory:// or redis://host:port/db
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url[len("sqlite:///"):])
+    if url.startswith("memory://"):
+        return KeyValueSessionStore(MemoryKeyValue())
+    if url.startswith(("redis://", "rediss://")):
+        import redis
+
+        return KeyValueSessionStore(redis.Redis.from_url(url))
+    raise ValueError(f"unknown session store {url!r}")
+
+
+class History(Sequence):
+    # A call's messages as a list that loads from the store on demand, newest
+    # first, a page at a time: building a prompt only touches the recent
+    # turns. append() writes the one new message through to the store.
+
+    def __init__(self, store, call_id, page=32):
+        self.store = store
+        self.call_id = call_id
+        self.page = page
+        self._start = store.count(call_id)
+        self._messages = []
+
+    def __len__(self):
+        return self._start + len(self._messages)
+
+    def _load_from(self, index):
+        if index < self._start:
+            start = max(0, min(index, self._start - self.page))
+            self._messages = self.store.load(self.call_id, start, self._start) + self._messages
+            self._start = start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0:
+                return list(self)[index]
+            if start < stop:
+                self._load_from(start)
+            return self._messages[slice(start - self._start, stop - self._start, step)] if start < stop else []
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        self._load_from(index)
+        return self._messages[index - self._start]
+
+    def __iter__(self):
+        self._load_from(0)
+        return iter(list(self._messages))
+
+    def append(self, message):
+        self.store.append(self.call_id, message)
+        self._messages.append(message)
@@ -0,0 +1,61 @@
+import io
+import re
+
+# A segment ends at sentence punctuation followed by whitespace; once the
+# buffer gets long enough we also cut at the last clause boundary so the first
+# spoken words do not wait for a long run-on sentence.
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s")
+CLAUSE_END = re.compile(r"[,;:—]\s")
+MIN_CLAUSE_CHARS = 60
+
+
+def _find_cut(buffer, min_clause_chars):
+    match = SENTENCE_END.search(buffer)
+    if match:
+        return match.end()
+    if len(buffer) >= min_clause_chars:
+        clauses = list(CLAUSE_END.finditer(buffer))
+        if clauses:
+            return clauses[-1].end()
+    return None
+
+
+class SentenceChunker:
+    def __init__(self, min_clause_chars=MIN_CLAUSE_CHARS):
+        self.min_clause_chars = min_clause_chars
+        self.buffer = ""
+
+    def feed(self, token):
+        self.buffer += token
+        segments = []
+        cut = _find_cut(self.buffer, self.min_clause_chars)
+        while cut is not None:
+            segment, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if segment:
+                segments.append(segment)
+            cut = _find_cut(self.buffer, self.min_clause_chars)
+        return segments
+
+    def flush(self):
+        segment, self.buffer = self.buffer.strip(), ""
+        return [segment] if segment else []
+
+
+def chunk_sentences(tokens, min_clause_chars=MIN_CLAUSE_CHARS):
+    chunker = SentenceChunker(min_clause_chars)
+    for token in tokens:
+        yield from chunker.feed(token)
+    yield from chunker.flush()
+
+
+def audio_duration(data):
+    import av
+
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.audio[0]
+        samples = 0
+        rate = stream.rate
+        for frame in container.decode(stream):
+            samples += frame.samples
+            rate = frame.sample_rate
+    return samples / rate if rate else 0.0
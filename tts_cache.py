@@ -0,0 +1,134 @@
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from media_server import media_key
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def tts_key(text, voice, model, response_format="mp3"):
+    # MP3 keys predate the format option and are left as they were so
+    # existing cache entries stay valid.
+    if response_format == "mp3":
+        return media_key(model, voice, normalize_text(text))
+    return media_key(model, voice, response_format, normalize_text(text))
+
+
+class TTSCache:
+    # Two tiers of synthesized audio: a byte-bounded LRU in memory backed by
+    # a size-capped directory of clips that survives restarts. Clips on disk
+    # are named after the key with the extension of the format they are in.
+
+    def __init__(self, memory_bytes=32 * 1024 * 1024, disk_dir=None, disk_bytes=512 * 1024 * 1024,
+                 extension="mp3"):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.extension = extension
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        entries = []
+        suffix = f".{self.extension}"
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(suffix):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                entries.append((stat.st_atime, name[:-len(suffix)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.{self.extension}")
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return data
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk.move_to_end(key)
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self.counters["disk_hits"] += 1
+                    self._put_memory(key, data)
+                return data
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, data):
+        with self._lock:
+            self._put_memory(key, data)
+            write = self.disk_dir and key not in self._disk and len(data) <= self.disk_bytes
+        if write:
+            temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = len(data)
+                    self._disk_size += len(data)
+                self._evict_disk()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_size,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_size,
+            )
+
+    def _put_memory(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+            self.counters["memory_evictions"] += 1
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            self.counters["disk_evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,136 @@
+import io
+import wave
+from collections import deque
+
+import numpy as np
+
+from audio_format import VAD_SAMPLE_RATE
+
+
+def resample_frames(frames, resampler):
+    # Decode av.AudioFrames from the browser into one mono int16 array.
+    chunks = []
+    for frame in frames:
+        for resampled in resampler.resample(frame):
+            chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.int16)
+    return np.concatenate(chunks)
+
+
+def pcm_to_wav(samples, sample_rate=VAD_SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(np.asarray(samples, dtype=np.int16).tobytes())
+    return buffer.getvalue()
+
+
+class VoiceActivityDetector:
+    # Energy / zero-crossing endpointer. Frame features are computed for the
+    # whole incoming block at once; only the small per-frame state machine
+    # (onset, hangover) runs in Python.
+
+    def __init__(self, sample_rate=VAD_SAMPLE_RATE, frame_ms=20, energy_ratio=3.0,
+                 min_energy=0.004, max_zcr=0.35, onset_ms=60, hangover_ms=400,
+                 pre_roll_ms=200, min_speech_ms=250, max_utterance_s=30, noise_window_s=3):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_len = sample_rate * frame_ms // 1000
+        self.energy_ratio = energy_ratio
+        self.min_energy = min_energy
+        self.max_zcr = max_zcr
+        self.onset_frames = max(1, onset_ms // frame_ms)
+        self.hangover_frames = max(1, hangover_ms // frame_ms)
+        self.pre_roll_frames = pre_roll_ms // frame_ms
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.max_utterance_frames = max_utterance_s * 1000 // frame_ms
+        self.noise_floor = min_energy
+        # The floor is the quietest frame of the last noise_window_s: pauses
+        # between words reach down to it, and it follows steady noise up or
+        # down whatever the frames were classed as.
+        self._energies = deque(maxlen=max(1, noise_window_s * 1000 // frame_ms))
+        self.reset()
+
+    def reset(self):
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._frames = []
+        self._in_speech = False
+        self._voiced_run = 0
+        self._silent_run = 0
+        self._speech_frames = 0
+
+    @property
+    def in_speech(self):
+        return self._in_speech
+
+    @property
+    def buffered_samples(self):
+        # Length of the utterance so far, pre-roll included.
+        return len(self._frames) * self.frame_len if self._in_speech else 0
+
+    @property
+    def trailing_silence_ms(self):
+        return self._silent_run * self.frame_ms
+
+    def buffered(self, start=0):
+        return np.concatenate(self._frames[start // self.frame_len:])
+
+    def classify(self, frames):
+        x = frames.astype(np.float32) / 32768.0
+        energy = np.sqrt(np.mean(x * x, axis=1))
+        zcr = np.mean(np.signbit(x[:, 1:]) != np.signbit(x[:, :-1]), axis=1)
+        self._energies.extend(energy.tolist())
+        self.noise_floor = min(self._energies)
+        threshold = max(self.min_energy, self.noise_floor * self.energy_ratio)
+        voiced = (energy > threshold) & (zcr < self.max_zcr)
+        # Loud unvoiced sounds (fricatives) still count as speech.
+        voiced |= energy > threshold * 2
+        return voiced
+
+    def feed(self, samples):
+        samples = np.concatenate([self._pending, np.asarray(samples, dtype=np.int16)])
+        count = samples.size // self.frame_len
+        self._pending = samples[count * self.frame_len:]
+        if not count:
+            return []
+        frames = samples[:count * self.frame_len].reshape(count, self.frame_len)
+        utterances = []
+        for frame, voiced in zip(frames, self.classify(frames)):
+            self._frames.append(frame)
+            if not self._in_speech:
+                self._voiced_run = self._voiced_run + 1 if voiced else 0
+                if self._voiced_run >= self.onset_frames:
+                    self._in_speech = True
+                    self._silent_run = 0
+                    self._speech_frames = self._voiced_run
+                else:
+                    keep = self.pre_roll_frames + self._voiced_run
+                    if len(self._frames) > keep:
+                        del self._frames[:len(self._frames) - keep]
+                continue
+            self._speech_frames += 1
+            self._silent_run = 0 if voiced else self._silent_run + 1
+            if self._silent_run >= self.hangover_frames or len(self._frames) >= self.max_utterance_frames:
+                utterance = self._finish()
+                if utterance is not None:
+                    utterances.append(utterance)
+        return utterances
+
+    def flush(self):
+        utterance = self._finish() if self._in_speech else None
+        self.reset()
+        return utterance
+
+    def _finish(self):
+        frames, speech = self._frames, self._speech_frames - self._silent_run
+        self._frames = []
+        self._in_speech = False
+        self._voiced_run = 0
+        self._silent_run = 0
+        self._speech_frames = 0
+        if speech < self.min_speech_frames:
+            return None
+        return np.concatenate(frames)